@@ -3,6 +3,7 @@ import cors from "cors";
 import express from "express";
 import GetJob from "./app/controllers/job/get";
 import PutJob from "./app/controllers/job/put";
+import BatchUpdateJob from "./app/controllers/mgmt/batchUpdate";
 import DequeueJob from "./app/controllers/mgmt/dequeue";
 import ListResumableJobs from "./app/controllers/mgmt/resumable";
 import UpdateJob from "./app/controllers/mgmt/update";
@@ -20,5 +21,6 @@ app.put("/api/v1/jobs", PutJob);
 app.get("/api/v1/mgmt/dequeue", RequiresKey(), DequeueJob);
 app.get("/api/v1/mgmt/resumable", RequiresKey(), ListResumableJobs);
 app.patch("/api/v1/mgmt/update/:jobId", RequiresKey(), UpdateJob);
+app.patch("/api/v1/mgmt/update/:jobId/batch", RequiresKey(), BatchUpdateJob);
 
 export default app;
@@ -2,6 +2,7 @@ import { Request, Response } from "express";
 import Job from "../../models/Job";
 import Status from "../../status";
 import { Fernet } from "fernet-nodejs";
+import { notifyEnqueued } from "../../jobEvents";
 
 type OAuthTokenResponse = {
   access_token: string;
@@ -32,6 +33,7 @@ export default async (req: Request, res: Response) => {
           [
             "Missing a required parameter in the JSON body",
             "Required params: clientOauthCode: string, curseforgeSlug: string, modrinthId: string",
+            "Optional params: profile: boolean",
           ].join(" ")
         );
     }
@@ -66,9 +68,12 @@ export default async (req: Request, res: Response) => {
       curseforgeSlug: req.body.curseforgeSlug,
       modrinthId: req.body.modrinthId,
       queuePlace: await getNextQueuePlace(),
+      // Optional: has the processor record a profile of this job in its log
+      profile: req.body.profile === true,
     });
 
     await newJob.save();
+    notifyEnqueued();
     return res.status(200).send(newJob.jobId);
   } catch (ex) {
     console.log(ex);
@@ -0,0 +1,30 @@
+/* Updates a job with a batch of logmsgs and/or a new status in a single write */
+
+import { Request, Response } from "express";
+import Jobs from "../../models/Job";
+
+export default async (req: Request, res: Response) => {
+  if (!req.params.jobId) {
+    return res.status(400).send("Field JobId is required in the body");
+  }
+
+  const logs: string[] = Array.isArray(req.body.logs) ? req.body.logs : [];
+  if (req.body.status === undefined && !logs.length) {
+    return res.status(400).send("At least one of logs or status is required");
+  }
+
+  const job = await Jobs.findOne({ jobId: req.params.jobId });
+  if (!job) {
+    return res
+      .status(400)
+      .send(`Job with ID ${req.params.jobId} was not found`);
+  }
+
+  // Logs arrive oldest first, but are stored newest first like in UpdateJob
+  const newestFirst = [...logs].reverse().join("\n");
+  req.body.status !== undefined && (job.status = req.body.status);
+  logs.length && (job.logs = `${newestFirst}\n${job.logs}`);
+  await job.save();
+
+  return res.status(200).send();
+};
@@ -1,12 +1,48 @@
-/* Gets the next job in the queue */
+/*
+ * Claims the next job in the queue, marking it as processing in the same write.
+ * With ?wait=<seconds> the request is held open until a job is enqueued or the
+ * wait runs out, so idle processors don't need to poll.
+ */
 import { Request, Response } from "express";
+import { listenForEnqueue } from "../../jobEvents";
 import Jobs from "../../models/Job";
 import Status from "../../status";
 
+const MAX_WAIT_SECS = 60;
+
+const claimNext = () =>
+  Jobs.findOneAndUpdate(
+    { status: Status.ENQUEUED },
+    { $set: { status: Status.PROCESSING } },
+    { sort: { queuePlace: "asc" }, new: true }
+  );
+
 export default async (req: Request, res: Response) => {
-  const [job] = await Jobs.find({ status: Status.ENQUEUED })
-    .sort({ queuePlace: "asc" })
-    .limit(1);
+  const waitSecs = Math.min(Number(req.query.wait) || 0, MAX_WAIT_SECS);
+  const deadline = Date.now() + waitSecs * 1000;
+
+  let closed = false;
+  res.on("close", () => (closed = true));
+
+  // Listen before every claim, so a job enqueued while the claim is in flight
+  // still wakes us up instead of waiting out the deadline
+  let enqueued = listenForEnqueue();
+  let job = await claimNext();
+  while (!job && !closed && Date.now() < deadline) {
+    await enqueued.wait(deadline - Date.now());
+    enqueued = listenForEnqueue();
+    job = await claimNext();
+  }
+  enqueued.cancel();
+
+  if (job && closed) {
+    // Nobody is left to process it, so put it back in the queue
+    await Jobs.updateOne(
+      { jobId: job.jobId },
+      { $set: { status: Status.ENQUEUED } }
+    );
+    return;
+  }
 
   if (job) {
     return res.status(200).json(job);
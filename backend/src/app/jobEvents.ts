@@ -0,0 +1,44 @@
+import { EventEmitter } from "events";
+
+/* Lets waiting dequeue requests know as soon as a new job is enqueued */
+const events = new EventEmitter();
+events.setMaxListeners(0);
+
+export const notifyEnqueued = () => {
+  events.emit("enqueued");
+};
+
+/*
+ * Starts listening for a new job straight away, so one enqueued while the caller
+ * is still checking the queue isn't missed. wait() resolves as soon as a job was
+ * (or is) enqueued, or once the timeout runs out; cancel() stops listening.
+ */
+export const listenForEnqueue = () => {
+  let fired = false;
+  let wake = () => {};
+  const onEnqueued = () => {
+    fired = true;
+    wake();
+  };
+  const cancel = () => {
+    events.off("enqueued", onEnqueued);
+  };
+  events.once("enqueued", onEnqueued);
+
+  const wait = (timeoutMs: number) =>
+    new Promise<void>((resolve) => {
+      if (fired) {
+        return resolve();
+      }
+      const timer = setTimeout(() => {
+        cancel();
+        resolve();
+      }, timeoutMs);
+      wake = () => {
+        clearTimeout(timer);
+        resolve();
+      };
+    });
+
+  return { wait, cancel };
+};
@@ -10,6 +10,8 @@ export type JobType = Document & {
   logs: string;
   status: number;
   queuePlace: number;
+  enqueuedAt: Date;
+  profile: boolean;
 };
 
 const JobSchema = new Schema<JobType>({
@@ -42,6 +44,14 @@ const JobSchema = new Schema<JobType>({
     type: Number,
     required: true,
   },
+  enqueuedAt: {
+    type: Date,
+    default: Date.now,
+  },
+  profile: {
+    type: Boolean,
+    default: false,
+  },
 });
 
 export default model<JobType>("jobs", JobSchema, "jobs");
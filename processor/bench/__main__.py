@@ -0,0 +1,204 @@
+"""
+Benchmarks the processor end to end against local fake APIs
+Author: oitsjustjose @ modrinth/curseforge/twitter
+
+Usage: python bench [--jobs 4] [--files 200] [--engine threads|async] ...
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from importlib import util
+from multiprocessing import Process, Queue
+from os import chdir, getcwd
+from os import environ as env
+from os import path
+from tempfile import TemporaryDirectory
+from time import monotonic
+from typing import Dict, List
+
+import requests
+from cryptography.fernet import Fernet
+
+from fake_servers import FakeConfig, serve
+
+
+def parse_args() -> argparse.Namespace:
+    """Returns: (Namespace): the benchmark's settings"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=4, help="jobs to enqueue")
+    parser.add_argument("--files", type=int, default=200, help="files per job")
+    parser.add_argument("--jar-kib", type=int, default=256, help="size of each jar")
+    parser.add_argument("--latency-ms", type=float, default=20, help="per request")
+    parser.add_argument(
+        "--bandwidth-kib", type=int, default=0, help="per download, 0 for unlimited"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--slots", type=int, default=int(env.get("CTM_JOB_SLOTS", "2")))
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads")
+    parser.add_argument("--json", help="also write the report to this file")
+    return parser.parse_args()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    Args:
+        values (List[float]): the samples
+        pct (float): the percentile, 0-100
+    Returns: (float): the nearest-rank percentile, 0 if there are no samples
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def cold_start(src: str, runs: int = 3) -> float:
+    """
+    Times a fresh interpreter loading the processor's entrypoint, without running it
+    Args:
+        src (str): the processor's src directory
+        runs (int): how many interpreters to time
+    Returns: (float): the median time in seconds
+    """
+    code = (
+        "import sys\n"
+        "from importlib import util\n"
+        "sys.path.insert(0, sys.argv[1])\n"
+        "spec = util.spec_from_file_location('ctm_main', sys.argv[1] + '/__main__.py')\n"
+        "spec.loader.exec_module(util.module_from_spec(spec))\n"
+        "assert 'selenium' not in sys.modules, 'the browser stack was loaded eagerly'\n"
+    )
+    times = []
+    for _ in range(runs):
+        started = monotonic()
+        subprocess.run([sys.executable, "-c", code, src], check=True)
+        times.append(monotonic() - started)
+    return percentile(times, 50)
+
+
+def run_threads(src: str, slots: int) -> None:
+    """Drains the fake queue with run_job, `slots` jobs at a time"""
+    from mgmt_tools import MgmtApiHelper  # pylint: disable=import-outside-toplevel
+
+    # The processor's entrypoint is a __main__.py, so it is loaded under another name
+    spec = util.spec_from_file_location("ctm_main", path.join(src, "__main__.py"))
+    ctm = util.module_from_spec(spec)
+    spec.loader.exec_module(ctm)
+
+    helper = MgmtApiHelper()
+    with ThreadPoolExecutor(max_workers=slots) as pool:
+        while job := helper.get_next_job():
+            pool.submit(ctm.run_job, helper, job)
+    helper.flush()
+
+
+def run_async(slots: int) -> None:
+    """Drains the fake queue with run_job_async, `slots` jobs at a time"""
+    # pylint: disable=import-outside-toplevel
+    import async_http_client
+    from async_main import run_job_async
+    from async_mgmt_tools import AsyncMgmtApiHelper
+
+    async def drain():
+        helper = AsyncMgmtApiHelper()
+        limit = asyncio.Semaphore(slots)
+
+        async def one(job):
+            async with limit:
+                await run_job_async(helper, job)
+
+        tasks = []
+        while job := await helper.get_next_job_async():
+            tasks.append(asyncio.create_task(one(job)))
+        await asyncio.gather(*tasks)
+        await helper.flush_async()
+        await async_http_client.close()
+
+    asyncio.run(drain())
+
+
+def main():
+    """Runs the benchmark and prints its report"""
+    args = parse_args()
+    report_path = path.realpath(args.json) if args.json else None
+    config = FakeConfig(
+        jobs=args.jobs,
+        files=args.files,
+        jar_bytes=args.jar_kib * 1024,
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_kib * 1024,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        secret=Fernet.generate_key().decode("utf-8"),
+    )
+
+    ports: Queue = Queue()
+    fakes = Process(target=serve, args=(config, ports), daemon=True)
+    fakes.start()
+    curse_port, modrinth_port, mgmt_port = ports.get(timeout=30)
+
+    with TemporaryDirectory() as workdir:
+        # Must all be set before the processor's modules are imported
+        env.update(
+            {
+                "CTM_CURSE_API": f"http://127.0.0.1:{curse_port}",
+                "CTM_MODRINTH_API": f"http://127.0.0.1:{modrinth_port}",
+                "MGMT_HOST": f"http://127.0.0.1:{mgmt_port}",
+                "MGMT_KEY": "bench",
+                "CURSE_API_KEY": "bench",
+                "SECRET": config.secret,
+                "CTM_JOURNAL_DIR": path.join(workdir, "journal"),
+            }
+        )
+        src = path.realpath(path.join(path.dirname(__file__), "..", "src"))
+        sys.path.insert(0, src)
+        cold = cold_start(src)
+        cwd = getcwd()
+        chdir(workdir)  # The fast path's scratch jars land in the working directory
+
+        started = monotonic()
+        try:
+            if args.engine == "async":
+                run_async(args.slots)
+            else:
+                run_threads(src, args.slots)
+        finally:
+            elapsed = monotonic() - started
+            chdir(cwd)
+
+    stats: Dict = requests.get(
+        f"http://127.0.0.1:{mgmt_port}/__stats", timeout=30
+    ).json()
+    fakes.terminate()
+
+    latencies = stats["latencies"]
+    report = {
+        "engine": args.engine,
+        "jobs": args.jobs,
+        "files": args.jobs * args.files,
+        "uploaded": stats["uploads"],
+        "seconds": round(elapsed, 2),
+        "jobs_per_min": round(args.jobs / elapsed * 60, 2),
+        "files_per_sec": round(stats["uploads"] / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "cold_start_ms": round(cold * 1000, 1),
+        "peak_rss_mib": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+    for key, value in report.items():
+        print(f"{key:>14}: {value}")
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
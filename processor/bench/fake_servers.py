@@ -0,0 +1,313 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: Local stand-ins for the CurseForge, Modrinth and Management APIs so the
+    processor can be benchmarked without touching the network
+"""
+
+import hashlib
+import json
+import re
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import random
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from cryptography.fernet import Fernet
+
+
+@dataclass
+class FakeConfig:
+    """How the fake servers behave"""
+
+    jobs: int = 4
+    files: int = 200
+    jar_bytes: int = 256 * 1024
+    latency: float = 0.02  # seconds added to every request
+    bandwidth: int = 0  # bytes per second per download, 0 for unlimited
+    error_rate: float = 0.0  # chance a download or upload fails with a 500
+    throttle_rate: float = 0.0  # chance an upload is turned away with a 429
+    secret: str = ""
+
+
+class FakeState:
+    """Everything the fakes share, plus the timings the benchmark reports on"""
+
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.lock = Lock()
+        self.queue = [f"bench-{idx}" for idx in range(config.jobs)]
+        self.statuses: Dict[str, int] = {}
+        self.started: Dict[str, float] = {}
+        self.latencies: List[float] = []
+        self.uploads = 0
+        self._jars: Dict[int, Tuple[bytes, str]] = {}
+
+    def jar(self, file_id: int) -> Tuple[bytes, str]:
+        """
+        Args: file_id (int): the fake CurseForge file id
+        Returns: (Tuple[bytes, str]): the synthetic jar and its sha1
+        """
+        with self.lock:
+            if file_id not in self._jars:
+                block = hashlib.sha256(str(file_id).encode("utf-8")).digest()
+                data = (block * (self.config.jar_bytes // len(block) + 1))[
+                    : self.config.jar_bytes
+                ]
+                self._jars[file_id] = (data, hashlib.sha1(data).hexdigest())
+            return self._jars[file_id]
+
+
+def mod_id_for(slug: str) -> int:
+    """The fake CurseForge mod id for a bench-N slug"""
+    return 1000 + int(slug.rsplit("-", 1)[1])
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """The shared plumbing for every fake"""
+
+    protocol_version = "HTTP/1.1"
+    state: FakeState = None
+
+    def log_message(self, *_args) -> None:  # pylint: disable=arguments-differ
+        pass
+
+    def _read_body(self) -> bytes:
+        """Reads the request body, whether it has a Content-Length or is chunked"""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(self, status: int, payload=None, headers: Dict[str, str] = None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self) -> Tuple[str, Dict[str, List[str]]]:
+        sleep(self.state.config.latency)
+        url = urlparse(self.path)
+        return url.path, parse_qs(url.query)
+
+
+class FakeCurse(FakeHandler):
+    """CurseForge's v1 search, files and changelog endpoints"""
+
+    cdn_url = ""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        path, query = self._route()
+        config = self.state.config
+
+        if path == "/v1/mods/search":
+            self._send(200, {"data": [{"id": mod_id_for(query["slug"][0])}]})
+        elif match := re.fullmatch(r"/v1/mods/(\d+)/files", path):
+            mod_id = int(match.group(1))
+            index = int(query.get("index", ["0"])[0])
+            page_size = int(query.get("pageSize", ["50"])[0])
+            ids = range(index, min(index + page_size, config.files))
+            self._send(
+                200,
+                {
+                    "data": [self._file(mod_id * 100000 + idx) for idx in ids],
+                    "pagination": {
+                        "index": index,
+                        "pageSize": page_size,
+                        "resultCount": len(ids),
+                        "totalCount": config.files,
+                    },
+                },
+            )
+        elif re.fullmatch(r"/v1/mods/\d+/files/\d+/changelog", path):
+            self._send(200, {"data": "<p>Benchmark build</p>"})
+        else:
+            self._send(404)
+
+    def _file(self, file_id: int) -> Dict:
+        """A file record shaped like the ones from /v1/mods/{id}/files"""
+        _, sha1 = self.state.jar(file_id)
+        name = f"bench-{file_id}.jar"
+        return {
+            "id": file_id,
+            "displayName": f"Bench Mod 1.19.2-{file_id}",
+            "fileName": name,
+            "isAvailable": True,
+            "downloadUrl": f"{self.cdn_url}/files/{file_id}/{name}",
+            "gameVersions": ["1.19.2", "Forge"],
+            "releaseType": 1,
+            "fileLength": self.state.config.jar_bytes,
+            "hashes": [{"value": sha1, "algo": 1}],
+        }
+
+
+class FakeCdn(FakeHandler):
+    """CurseForge's jar CDN, which lives on a host of its own"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        path, _ = self._route()
+        if match := re.fullmatch(r"/files/(\d+)/(.+\.jar)", path):
+            self._download(int(match.group(1)), match.group(2))
+        else:
+            self._send(404)
+
+    def _download(self, file_id: int, name: str) -> None:
+        with self.state.lock:
+            self.state.started.setdefault(name, monotonic())
+        if random() < self.state.config.error_rate:
+            self._send(500)
+            return
+
+        data, _ = self.state.jar(file_id)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/java-archive")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        chunk = 16 * 1024
+        for start in range(0, len(data), chunk):
+            self.wfile.write(data[start : start + chunk])
+            if self.state.config.bandwidth:
+                sleep(chunk / self.state.config.bandwidth)
+
+
+class FakeModrinth(FakeHandler):
+    """Modrinth's project version listing and /v2/version upload endpoint"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        path, _ = self._route()
+        if re.fullmatch(r"/v2/project/[^/]+/version", path):
+            self._send(200, [])
+        else:
+            self._send(404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        path, _ = self._route()
+        body = self._read_body()
+        if path != "/v2/version":
+            self._send(404)
+            return
+        if random() < self.state.config.throttle_rate:
+            self._send(429, {"description": "Slow down"}, {"Retry-After": "1"})
+            return
+        if random() < self.state.config.error_rate:
+            self._send(500, {"description": "Injected failure"})
+            return
+
+        boundary = re.search(r"boundary=(\S+)", self.headers["Content-Type"]).group(1)
+        data_part, file_part = body.split(f"--{boundary}\r\n".encode("utf-8"))[1:3]
+        payload = json.loads(data_part.split(b"\r\n\r\n", 1)[1].rstrip(b"\r\n"))
+        jar = file_part.split(b"\r\n\r\n", 1)[1]
+        jar = jar[: jar.rindex(f"\r\n--{boundary}--".encode("utf-8"))]
+
+        name = payload["primary_file"]
+        with self.state.lock:
+            self.state.uploads += 1
+            if name in self.state.started:
+                self.state.latencies.append(monotonic() - self.state.started.pop(name))
+        self._send(
+            200,
+            {
+                "id": name,
+                "files": [
+                    {
+                        "filename": name,
+                        "hashes": {
+                            "sha1": hashlib.sha1(jar).hexdigest(),
+                            "sha512": hashlib.sha512(jar).hexdigest(),
+                        },
+                    }
+                ],
+            },
+        )
+
+
+class FakeMgmt(FakeHandler):
+    """The Management API's dequeue, resumable and update endpoints"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        path, _ = self._route()
+        if path == "/api/v1/mgmt/resumable":
+            self._send(200, [])
+        elif path == "/api/v1/mgmt/dequeue":
+            with self.state.lock:
+                job_id = self.state.queue.pop(0) if self.state.queue else None
+            if not job_id:
+                self._send(404)
+                return
+            self._send(200, self._job(job_id))
+        elif path == "/__stats":
+            with self.state.lock:
+                self._send(
+                    200,
+                    {
+                        "latencies": self.state.latencies,
+                        "uploads": self.state.uploads,
+                        "statuses": self.state.statuses,
+                    },
+                )
+        else:
+            self._send(404)
+
+    def do_PATCH(self):  # pylint: disable=invalid-name
+        path, _ = self._route()
+        body = self._read_body()
+        if match := re.fullmatch(r"/api/v1/mgmt/update/([^/]+)/batch", path):
+            status = json.loads(body or b"{}").get("status")
+        elif match := re.fullmatch(r"/api/v1/mgmt/update/([^/]+)", path):
+            status = parse_qs(body.decode("utf-8")).get("status", [None])[0]
+        else:
+            self._send(404)
+            return
+
+        if status is not None:
+            with self.state.lock:
+                self.state.statuses[match.group(1)] = int(status)
+        self._send(200, {})
+
+    def _job(self, job_id: str) -> Dict:
+        """A job document shaped like the ones from the dequeue endpoint"""
+        token = Fernet(self.state.config.secret.encode("utf-8")).encrypt(b"bench")
+        return {
+            "jobId": job_id,
+            "oauthToken": token.decode("utf-8"),
+            "curseforgeSlug": job_id,
+            "modrinthId": f"modrinth-{job_id}",
+            "status": 1,
+            "queuePlace": 0,
+        }
+
+
+def serve(config: FakeConfig, ports) -> None:
+    """
+    Runs all three fakes until the process is killed - meant to be the target of a
+        separate process, so the fakes never count towards the processor's memory
+    Args:
+        config (FakeConfig): how the fakes behave
+        ports: a multiprocessing queue the bound (curse, modrinth, mgmt) ports go to
+    """
+    state = FakeState(config)
+    servers = []
+    for handler in (FakeCurse, FakeModrinth, FakeMgmt, FakeCdn):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        handler.state = state
+        servers.append(server)
+    FakeCurse.cdn_url = f"http://127.0.0.1:{servers[-1].server_port}"
+
+    for server in servers[1:]:
+        Thread(target=server.serve_forever, daemon=True).start()
+    ports.put(tuple(server.server_port for server in servers[:3]))
+    servers[0].serve_forever()
@@ -2,22 +2,39 @@
 Does the actual work behind the scenes
 Author: oitsjustjose @ modrinth/curseforge/twitter
 """
+import argparse
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from os import environ as env
-from os import system as run
+from threading import Thread
 from time import sleep
+from typing import List, Set
 
+import bulk
+import curse_api as cf
+import metrics
+import profiling
+import slow_path
 from common import Job, Status
+from curse_cache import get_cache
+from jar_store import get_store
+from journal import discard_journal
 from mgmt_tools import MgmtApiHelper
 from x_fast_provider import FastProvider
-from x_slow_provider import SlowProvider
 
 
-def process_job(helper: MgmtApiHelper, job: Job):
-    """Handles the download and upload process for a single job"""
+def process_job(helper: MgmtApiHelper, job: Job) -> Status:
+    """
+    Handles the download and upload process for a single job
+    Returns: (Status): the job's outcome
+    """
     helper.update_job_status(job.job_id, Status.PROCESSING)
+    curse = cf.CurseClient(
+        job.curseforge_slug, lambda msg: helper.append_job_log(job.job_id, msg)
+    )
 
     # Try to use the fast provider first
-    fast_prov = FastProvider(helper, job)
+    fast_prov = FastProvider(helper, job, curse)
     if fast_prov.supports_downloads():
         helper.append_job_log(
             job.job_id,
@@ -25,61 +42,156 @@ def process_job(helper: MgmtApiHelper, job: Job):
         )
         status = fast_prov.process()
         helper.update_job_status(job.job_id, Status.COMPLETE)
+        discard_journal(job.job_id)
+        metrics.JOBS.labels(status.name).inc()
         helper.append_job_log(job.job_id, f"***{status.name}***")
-        return
+        helper.flush()
+        return status
 
     # Otherwise use the slow provider since you're a goblin 👺
-    slow_prov = SlowProvider(helper, job)
+    slow_prov = slow_path.slow_provider(helper, job, curse)
     helper.append_job_log(
         job.job_id,
         f"ℹ️ Mod {job.curseforge_slug} does not support third-party launchers, migration will be slowed by workarounds 😭",
     )
     status = slow_prov.process()
     helper.update_job_status(job.job_id, Status.COMPLETE)
+    discard_journal(job.job_id)
+    metrics.JOBS.labels(status.name).inc()
     helper.append_job_log(job.job_id, f"***{status.name}***")
+    helper.flush()
+    return status
+
+
+def report_cache_stats():
+    """Prints the CurseForge metadata cache and jar store counters, if enabled"""
+    cache = get_cache()
+    if cache:
+        print(f"CurseForge cache: {cache.stats()}")
+    store = get_store()
+    if store:
+        print(f"Jar store: {store.stats()}")
+
+
+def run_job(helper: MgmtApiHelper, job: Job):
+    """Runs a single job inside a job slot, making sure failures are reported"""
+    try:
+        with profiling.profile_job(
+            job, lambda msg: helper.append_job_log(job.job_id, msg)
+        ):
+            process_job(helper, job)
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"Job {job.job_id} crashed:\n{exc}")
+        metrics.JOBS.labels("CRASHED").inc()
+        helper.append_job_log(job.job_id, f"🔥 Crashed: {exc}")
+        helper.update_job_status(job.job_id, Status.COMPLETE)
+        discard_journal(job.job_id)
+        helper.append_job_log(job.job_id, f"***{Status.FAIL.name}***")
+        helper.flush()
+    report_cache_stats()
 
 
-def resume(helper: MgmtApiHelper):
-    """Resumes processing jobs on server restart"""
+def resume(helper: MgmtApiHelper, pool: ThreadPoolExecutor) -> Set[Future]:
+    """
+    Resumes processing jobs on server restart, running them side by side
+    Returns: (Set[Future]): the slots taken up by resumed jobs
+    """
     print("Resuming jobs from last run")
 
+    running: Set[Future] = set()
     for job in helper.get_resumable_jobs():
         print(f"Resuming job {job.job_id}")
-        process_job(helper, job)
-
-
-def work(helper: MgmtApiHelper) -> bool:
-    """Does the actual lifting"""
-    sleep(2)  # Sleep to make sure DB processing is done
-    job: Job = helper.get_next_job()
+        running.add(pool.submit(run_job, helper, job))
+    return running
+
+
+def work(
+    helper: MgmtApiHelper,
+    pool: ThreadPoolExecutor,
+    running: Set[Future],
+    long_poll: int,
+) -> bool:
+    """
+    Claims the next job, if any, and starts it in a free job slot
+    Args: long_poll (int): seconds to wait on the API for a job, 0 to return at once
+    Returns: (bool): True if a job was started
+    """
+    job: Job = helper.get_next_job(long_poll)
     if not job:
         return False
-    process_job(helper, job)
+    metrics.claimed(job.enqueued_at)
+    running.add(pool.submit(run_job, helper, job))
     return True
 
 
 def main_loop():
     """The main process loop"""
-    helper = MgmtApiHelper()
-
-    print("Starting virtual display")
-    run("Xvfb -ac :99 -screen 0 1280x1024x16 &")
-    env["DISPLAY"] = ":99"
-    print("Done initializing VDisplay")
+    slots = max(1, int(env.get("CTM_JOB_SLOTS", "2")))
+    long_poll = max(0, int(env.get("CTM_LONG_POLL_SECS", "30")))
+    engine = env.get("CTM_ENGINE", "threads")
+    metrics.serve()
+
+    # The browser stack is only loaded (and Xvfb only started) for slow jobs, unless
+    # browsers are prewarmed
+    Thread(
+        target=slow_path.prewarm,
+        args=(int(env.get("CTM_BROWSER_PREWARM", "0")),),
+        daemon=True,
+    ).start()
+
+    if engine == "async":
+        from async_main import run_engine  # pylint: disable=import-outside-toplevel
+
+        run_engine(slots, long_poll)
+        print("Quitting")
+        return
 
-    print("Starting the job processor")
-    resume(helper)
+    helper = MgmtApiHelper()
+    print(f"Starting the job processor with {slots} job slot(s)")
+    pool = ThreadPoolExecutor(max_workers=slots, thread_name_prefix="job-slot")
+    running = resume(helper, pool)
+    print(f"Ready for jobs {metrics.ready():.2f}s after starting")
     while True:
         try:
-            if work(helper):
-                sleep(1)
-            else:
+            running = {x for x in running if not x.done()}
+            if len(running) >= slots:
+                wait(running, return_when=FIRST_COMPLETED)
+            elif not work(helper, pool, running, long_poll) and not long_poll:
                 sleep(5)
         except KeyboardInterrupt:
-            run("pkill -9 Xvfb")
+            pool.shutdown(wait=False, cancel_futures=True)
+            slow_path.shutdown()
             print("Quitting")
             break
 
 
+def bulk_main(args: List[str]):
+    """Migrates every project in a plan file, instead of polling the Management API"""
+    parser = argparse.ArgumentParser(
+        prog="python src/__main__.py bulk", description=bulk.load_plan.__doc__
+    )
+    parser.add_argument("plan", help="the plan file")
+    parser.add_argument("--report", help="also write the full report to this file")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(env.get("CTM_JOB_SLOTS", "2")),
+        help="projects to run at once",
+    )
+    opts = parser.parse_args(args)
+
+    jobs = bulk.load_plan(opts.plan)
+    print(f"Migrating {len(jobs)} project(s), {opts.concurrency} at a time")
+    try:
+        reports = bulk.run_plan(jobs, process_job, opts.concurrency)
+    finally:
+        slow_path.shutdown()
+    bulk.write_report(reports, opts.report)
+    report_cache_stats()
+
+
 if __name__ == "__main__":
-    main_loop()
+    if sys.argv[1:2] == ["bulk"]:
+        bulk_main(sys.argv[2:])
+    else:
+        main_loop()
@@ -0,0 +1,280 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: The asyncio counterpart to curse_api's CurseClient
+"""
+
+import asyncio
+from os import environ as env
+from typing import AsyncIterator, Callable, Dict, Tuple, Union
+
+import aiohttp
+
+from async_http_client import get_session, host_limit
+from async_scheduler import AsyncFairScheduler
+from common import ModFile
+from curse_api import FALLBACK_CHANGELOG, CurseClient, parse_listing
+from curse_cache import FILES_TTL, SLUG_TTL, get_cache
+from http_client import CURSE_API
+from metrics import retried, stage
+
+_prefetcher: Union[AsyncFairScheduler, None] = None
+
+
+def get_prefetcher() -> AsyncFairScheduler:
+    """
+    Returns: (AsyncFairScheduler): the event loop's changelog prefetcher, with
+        CTM_CHANGELOG_PREFETCH slots which take turns between mods
+    """
+    global _prefetcher  # pylint: disable=global-statement
+    if not _prefetcher:
+        slots = max(1, int(env.get("CTM_CHANGELOG_PREFETCH", "8")))
+        _prefetcher = AsyncFairScheduler(slots, max(1, slots // 2))
+    return _prefetcher
+
+
+class AsyncCurseClient:
+    """
+    A per-job async CurseForge client which resolves the slug once and memoizes file
+        listings, so each listing is fetched at most once per job
+    Args:
+        slug (str): the CurseForge slug for the job
+        logmsg (Callable[[str], None]): where to log failures to
+    """
+
+    def __init__(self, slug: str, logmsg: Callable[[str], None]):
+        self.slug = slug
+        self._logmsg = logmsg
+        self._headers = {"x-api-key": env["CURSE_API_KEY"]}
+        self._modid_lock = asyncio.Lock()
+        self._modid: Union[str, None] = None
+        self._modid_resolved = False
+        self._files: Dict[Tuple[int, Union[int, None]], asyncio.Task] = {}
+        self._changelogs: Dict[int, asyncio.Task] = {}
+
+    async def _get_json(self, url: str, **kwargs) -> Union[Dict, None]:
+        """
+        GETs a CurseForge endpoint
+        Args: url (str): the endpoint to GET
+        Returns: (Union[Dict, None]): the JSON payload, None on a bad response
+        """
+        attempt = 1
+        while True:
+            async with host_limit(url), get_session().get(
+                url, headers=self._headers, **kwargs
+            ) as response:
+                # The rate limiter holds the retry back for as long as Curse asked
+                if response.status == 429 and attempt < 5:
+                    attempt += 1
+                    retried(url)
+                    continue
+                if not response.ok:
+                    return None
+                return await response.json()
+
+    async def mod_id(self) -> Union[str, None]:
+        """Returns: (Union[str, None]): the mod id for the slug, resolved on first use"""
+        async with self._modid_lock:
+            if self._modid_resolved:
+                return self._modid
+
+            cache = get_cache()
+            if cache and (mod_id := cache.get(f"slug:{self.slug}")):
+                self._modid, self._modid_resolved = mod_id, True
+                return mod_id
+
+            try:
+                with stage("slug_lookup"):
+                    data = await self._get_json(
+                        f"{CURSE_API}/v1/mods/search",
+                        params={"gameId": 432, "slug": self.slug},
+                    )
+                if not data or not data["data"]:
+                    self._logmsg(f"🔥 Failed to get mod_id for {self.slug}")
+                else:
+                    self._modid = data["data"][0]["id"]
+                    if cache:
+                        cache.put(f"slug:{self.slug}", self._modid, SLUG_TTL)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self._logmsg("🕜 Timed out getting mod_id from slug")
+
+            self._modid_resolved = True
+            return self._modid
+
+    def to_sync(self) -> CurseClient:
+        """
+        Returns: (CurseClient): a sync client for the same job, seeded with the mod id
+            and every listing this client already fetched, so handing the job to
+            sync code (the slow provider) repeats neither
+        """
+        client = CurseClient(self.slug, self._logmsg)
+        if self._modid_resolved:
+            client.seed(
+                self._modid,
+                {
+                    key: task.result()
+                    for key, task in self._files.items()
+                    if task.done()
+                    and not task.cancelled()
+                    and not task.exception()
+                    and task.result()
+                },
+            )
+        return client
+
+    async def _fetch_files(
+        self, index: int, page_size: Union[int, None]
+    ) -> Union[Dict, None]:
+        """Fetches and parses a single listing of the mod's files, cache first"""
+        mod_id = await self.mod_id()
+        cache = get_cache()
+        cache_key = f"files:{mod_id}:{index}:{page_size}"
+        if cache and (listing := cache.get(cache_key)):
+            return parse_listing(listing)
+
+        params = {"index": index} if index else {}
+        if page_size is not None:
+            params["pageSize"] = page_size
+
+        with stage("enumerate"):
+            listing = await self._get_json(
+                f"{CURSE_API}/v1/mods/{mod_id}/files", params=params
+            )
+        if not listing:
+            return None
+        if cache:
+            cache.put(cache_key, listing, FILES_TTL)
+        return parse_listing(listing)
+
+    async def get_files(
+        self, index: int = 0, page_size: Union[int, None] = None
+    ) -> Union[Dict, None]:
+        """
+        Gets a single listing of the mod's files, memoized per (index, page_size)
+        Args:
+            index (int): the index query param
+            page_size (int): the pageSize query param, or None for Curse's default
+        Returns: (Union[Dict, None]): the JSON payload from /files with its `data`
+            parsed into ModFiles, None on failure
+        """
+        key = (index, page_size)
+        if key not in self._files:
+            self._files[key] = asyncio.ensure_future(
+                self._fetch_files(index, page_size)
+            )
+        try:
+            listing = await asyncio.shield(self._files[key])
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self._files.pop(key, None)
+            raise
+
+        if listing is None:  # Only successful listings are memoized
+            self._files.pop(key, None)
+        return listing
+
+    async def get_file_count(self) -> int:
+        """
+        Gets the total number of files the mod has
+        Returns (int): -1 on failure, the file count otherwise
+        """
+        try:
+            listing = await self.get_files()
+            if not listing:
+                self._logmsg("🔥 Failed to get mod list")
+                return -1
+            return listing["pagination"]["totalCount"]
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self._logmsg("🕜 Timed out getting mod list")
+            return -1
+
+    async def iter_files(self) -> AsyncIterator[ModFile]:
+        """
+        Yields every file record for the mod in listing order, with every page after
+            the first requested up front and bounded only by the host limit
+        Returns: (AsyncIterator[ModFile]): each file from /files
+        """
+        first = await self.get_files()
+        if not first:
+            self._logmsg("🔥 Failed to get mod list")
+            return
+
+        page_size = first["pagination"]["pageSize"]
+        total = first["pagination"]["totalCount"]
+        pending = [
+            (idx, asyncio.ensure_future(self.get_files(idx, page_size)))
+            for idx in range(page_size, total, page_size)
+        ]
+        try:
+            for mod in first["data"]:
+                yield mod
+            for idx, task in pending:
+                try:
+                    listing = await task
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    listing = None
+                if not listing:
+                    self._logmsg(
+                        f"🕜 Failed to list files {idx}-{idx + page_size} for {self.slug}"
+                    )
+                    continue
+                for mod in listing["data"]:
+                    yield mod
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    def prefetch_changelog(self, file_id: int) -> None:
+        """
+        Starts fetching a file's changelog in the background, so it is ready by the
+            time the file is uploaded
+        Args: file_id (int): the File ID in question
+        """
+        if file_id not in self._changelogs:
+            self._changelogs[file_id] = asyncio.ensure_future(
+                self._prefetch_changelog(file_id)
+            )
+
+    async def _prefetch_changelog(self, file_id: int) -> str:
+        """Fetches a changelog once it is this mod's turn at the prefetcher"""
+        async with get_prefetcher().slot(self.slug):
+            return await self._fetch_changelog(file_id)
+
+    def cancel_prefetch(self) -> None:
+        """Drops any prefetched changelogs which were never asked for"""
+        for task in self._changelogs.values():
+            task.cancel()
+        self._changelogs.clear()
+
+    async def get_changelog(self, file_id: int) -> str:
+        """
+        Gets the changelog from Curse for a given File ID of this mod, prefetched
+            if it can be
+        Args: file_id (int): the File ID in question
+        Returns: (str): the changelog or a reasonable fallback
+        """
+        task = self._changelogs.pop(file_id, None)
+        if task:
+            return await task
+        return await self._fetch_changelog(file_id)
+
+    async def _fetch_changelog(self, file_id: int) -> str:
+        """Fetches a changelog, cache first"""
+        mod_id = await self.mod_id()
+        cache = get_cache()
+        key = f"changelog:{mod_id}:{file_id}"
+        if cache and (changelog := cache.get(key)) is not None:
+            return changelog
+
+        try:
+            with stage("changelog"):
+                data = await self._get_json(
+                    f"{CURSE_API}/v1/mods/{mod_id}/files/{file_id}/changelog"
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return FALLBACK_CHANGELOG
+        if not data:
+            return FALLBACK_CHANGELOG
+
+        if cache:
+            cache.put(key, data["data"])
+        return data["data"]
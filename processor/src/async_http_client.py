@@ -0,0 +1,74 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: The asyncio counterpart to http_client - one shared aiohttp session
+    plus a concurrency limit per host
+"""
+
+import asyncio
+from os import environ as env
+from typing import Dict, Union
+from urllib.parse import urlparse
+
+import aiohttp
+
+from http_client import USER_AGENT
+from rate_limit import limiter_for
+
+TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+
+_session: Union[aiohttp.ClientSession, None] = None
+_limits: Dict[str, asyncio.Semaphore] = {}
+
+
+async def _on_request_start(_session, _ctx, params: aiohttp.TraceRequestStartParams):
+    """Holds each request back until its host's rate limiter lets it through"""
+    await asyncio.sleep(limiter_for(str(params.url)).reserve())
+
+
+async def _on_request_end(_session, _ctx, params: aiohttp.TraceRequestEndParams):
+    """Lets the host's rate limiter adapt to the response"""
+    limiter_for(str(params.url)).observe(
+        params.response.status, params.response.headers
+    )
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Gets the shared session, creating it on first use - must be called from the loop
+    Returns: (ClientSession): the session every async request goes through, each
+        request held back by its host's rate limiter
+    """
+    global _session  # pylint: disable=global-statement
+    if not _session or _session.closed:
+        tracing = aiohttp.TraceConfig()
+        tracing.on_request_start.append(_on_request_start)
+        tracing.on_request_end.append(_on_request_end)
+        _session = aiohttp.ClientSession(
+            trace_configs=[tracing],
+            connector=aiohttp.TCPConnector(limit=0, ttl_dns_cache=300),
+            headers={"User-Agent": USER_AGENT},
+            timeout=TIMEOUT,
+        )
+    return _session
+
+
+def host_limit(url: str) -> asyncio.Semaphore:
+    """
+    Gets the semaphore bounding how many requests may be in flight to a host
+    Args: url (str): any url on the host in question
+    Returns: (Semaphore): the host's semaphore, sized by CTM_ASYNC_HOST_LIMIT
+    """
+    host = urlparse(url).netloc
+    if host not in _limits:
+        _limits[host] = asyncio.Semaphore(int(env.get("CTM_ASYNC_HOST_LIMIT", "32")))
+    return _limits[host]
+
+
+async def close() -> None:
+    """Closes the shared session"""
+    global _session  # pylint: disable=global-statement
+    if _session and not _session.closed:
+        await _session.close()
+    _session = None
+    _limits.clear()
@@ -0,0 +1,133 @@
+"""
+The asyncio job engine, picked with CTM_ENGINE=async
+Author: oitsjustjose @ modrinth/curseforge/twitter
+"""
+
+import asyncio
+from typing import Set
+
+import async_http_client
+import metrics
+import profiling
+import slow_path
+from async_curse_api import AsyncCurseClient
+from async_mgmt_tools import AsyncMgmtApiHelper
+from common import Job, Status
+from curse_cache import get_cache
+from jar_store import get_store
+from journal import discard_journal
+from x_async_provider import AsyncFastProvider
+
+
+async def process_job_async(helper: AsyncMgmtApiHelper, job: Job):
+    """Handles the download and upload process for a single job"""
+    helper.update_job_status(job.job_id, Status.PROCESSING)
+    curse = AsyncCurseClient(
+        job.curseforge_slug, lambda msg: helper.append_job_log(job.job_id, msg)
+    )
+
+    # Try to use the fast provider first
+    fast_prov = AsyncFastProvider(helper, job, curse)
+    if await fast_prov.supports_downloads():
+        helper.append_job_log(
+            job.job_id,
+            f"ℹ️ Mod {job.curseforge_slug} supports third-party launchers, migration will be quick 🙂",
+        )
+        status = await fast_prov.process()
+        helper.update_job_status(job.job_id, Status.COMPLETE)
+        discard_journal(job.job_id)
+        metrics.JOBS.labels(status.name).inc()
+        helper.append_job_log(job.job_id, f"***{status.name}***")
+        await helper.flush_async()
+        return
+
+    # The slow provider drives a browser, so it keeps running on its own thread. It
+    # picks up the mod id and listings the async client already fetched
+    slow_prov = slow_path.slow_provider(helper, job, curse.to_sync())
+    helper.append_job_log(
+        job.job_id,
+        f"ℹ️ Mod {job.curseforge_slug} does not support third-party launchers, migration will be slowed by workarounds 😭",
+    )
+    status = await asyncio.to_thread(slow_prov.process)
+    helper.update_job_status(job.job_id, Status.COMPLETE)
+    discard_journal(job.job_id)
+    metrics.JOBS.labels(status.name).inc()
+    helper.append_job_log(job.job_id, f"***{status.name}***")
+    await helper.flush_async()
+
+
+async def run_job_async(helper: AsyncMgmtApiHelper, job: Job):
+    """Runs a single job inside a job slot, making sure failures are reported"""
+    try:
+        with profiling.profile_job(
+            job, lambda msg: helper.append_job_log(job.job_id, msg)
+        ):
+            await process_job_async(helper, job)
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"Job {job.job_id} crashed:\n{exc}")
+        metrics.JOBS.labels("CRASHED").inc()
+        helper.append_job_log(job.job_id, f"🔥 Crashed: {exc}")
+        helper.update_job_status(job.job_id, Status.COMPLETE)
+        discard_journal(job.job_id)
+        helper.append_job_log(job.job_id, f"***{Status.FAIL.name}***")
+        await helper.flush_async()
+    cache = get_cache()
+    if cache:
+        print(f"CurseForge cache: {cache.stats()}")
+    store = get_store()
+    if store:
+        print(f"Jar store: {store.stats()}")
+
+
+async def main_loop_async(helper: AsyncMgmtApiHelper, slots: int, long_poll: int):
+    """
+    The main process loop - every job is a task on one event loop instead of a thread
+    Args:
+        helper (AsyncMgmtApiHelper): the job database
+        slots (int): how many jobs may run at once
+        long_poll (int): seconds to wait on the API for a job, 0 to poll
+    """
+    print("Resuming jobs from last run")
+    running: Set[asyncio.Task] = set()
+    for job in await helper.get_resumable_jobs_async():
+        print(f"Resuming job {job.job_id}")
+        running.add(asyncio.create_task(run_job_async(helper, job)))
+
+    print(f"Ready for jobs {metrics.ready():.2f}s after starting")
+    try:
+        while True:
+            running = {x for x in running if not x.done()}
+            if len(running) >= slots:
+                await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            job = await helper.get_next_job_async(long_poll)
+            if job:
+                metrics.claimed(job.enqueued_at)
+                running.add(asyncio.create_task(run_job_async(helper, job)))
+            elif not long_poll:
+                await asyncio.sleep(5)
+    finally:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        await async_http_client.close()
+
+
+def run_engine(slots: int, long_poll: int):
+    """
+    Runs the asyncio engine until interrupted
+    Args:
+        slots (int): how many jobs may run at once
+        long_poll (int): seconds to wait on the API for a job, 0 to poll
+    """
+    print(f"Starting the async job processor with {slots} job slot(s)")
+    helper = AsyncMgmtApiHelper()
+    try:
+        asyncio.run(main_loop_async(helper, slots, long_poll))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        slow_path.shutdown()
@@ -0,0 +1,70 @@
+"""
+Houses async API Tools when communicating with the RESTful API
+Author: oitsjustjose @ modrinth/curseforge/twitter
+"""
+
+import asyncio
+from os import environ as env
+from typing import List, Union
+
+import aiohttp
+
+from async_http_client import get_session
+from common import Job
+from mgmt_tools import MgmtApiHelper
+
+
+class AsyncMgmtApiHelper(MgmtApiHelper):
+    """
+    The asyncio counterpart to MgmtApiHelper. Job lookups and flushes have awaitable
+        `_async` variants, while logs and status updates always go through the
+        LogSink's background thread so they never block the event loop. The sync
+        methods are left as they are, so it can stand in for MgmtApiHelper in sync
+        code such as the slow provider.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._params = {"mgmtKey": env["MGMT_KEY"]}
+        if not self._sink:
+            self._start_sink()
+
+    async def get_next_job_async(self, wait: int = 0) -> Union[Job, None]:
+        """
+        Claims the next job to do, if any
+        Args: wait (int): seconds the API may hold the request open waiting for a job
+        Returns: (Union[Job, None]): the claimed job, None if there was nothing to do
+        """
+        try:
+            async with get_session().get(
+                f"{self._mgmt_host}/api/v1/mgmt/dequeue",
+                params={**self._params, "wait": wait},
+                timeout=aiohttp.ClientTimeout(total=self._mgmt_timeout + wait),
+            ) as resp:
+                # 404 response is for if there's nothing to dequeue
+                if resp.status == 404:
+                    return None
+                return self._dict_to_job(await resp.json())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            print("Failed to get next job:")
+            print(exc)
+            await asyncio.sleep(self._mgmt_timeout)  # Don't spin on an unreachable API
+            return None
+
+    async def get_resumable_jobs_async(self) -> List[Job]:
+        """Gets all active jobs - only used for resuming between restarts"""
+        try:
+            async with get_session().get(
+                f"{self._mgmt_host}/api/v1/mgmt/resumable",
+                params=self._params,
+                timeout=aiohttp.ClientTimeout(total=self._mgmt_timeout),
+            ) as resp:
+                return [self._dict_to_job(x) for x in await resp.json()]
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            print("Failed to get resumable jobs:")
+            print(exc)
+            return []
+
+    async def flush_async(self) -> None:
+        """Ships any buffered logs and status updates without blocking the loop"""
+        await asyncio.to_thread(self.flush)
@@ -0,0 +1,92 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: The asyncio counterpart to scheduler's FairScheduler
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from os import environ as env
+from typing import AsyncIterator, Deque, Dict, Union
+
+
+class AsyncFairScheduler:
+    """
+    Hands out transfer slots to every job's file tasks. Jobs take turns round-robin,
+        so a job with thousands of files waiting cannot hold up one with a handful.
+        Each job also has at most `per_job` slots at once.
+    Args:
+        slots (int): how many files may transfer at once across all jobs
+        per_job (int): how many files of a single job may transfer at once
+    """
+
+    def __init__(self, slots: int, per_job: int):
+        self._slots = slots
+        self._per_job = per_job
+        self._waiting: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._running: Dict[str, int] = {}
+
+    def _dispatch(self) -> None:
+        """Grants free slots to waiting jobs, taking turns between them"""
+        while sum(self._running.values()) < self._slots:
+            for job_id, waiters in self._waiting.items():
+                if self._running.get(job_id, 0) >= self._per_job:
+                    continue
+                waiter = waiters.popleft()
+                if waiters:
+                    self._waiting.move_to_end(job_id)  # Back of the line
+                else:
+                    del self._waiting[job_id]
+                if waiter.done():  # Cancelled while it waited
+                    break
+                self._running[job_id] = self._running.get(job_id, 0) + 1
+                waiter.set_result(None)
+                break
+            else:
+                return
+
+    def _release(self, job_id: str) -> None:
+        """Gives a job's slot back and passes it on"""
+        self._running[job_id] -= 1
+        if not self._running[job_id]:
+            del self._running[job_id]
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, job_id: str) -> AsyncIterator[None]:
+        """
+        Waits for the job's turn at a transfer slot, holding it for the block
+        Args: job_id (str): the job the file belongs to
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(job_id, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(job_id)  # Granted just as it was cancelled
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(job_id)
+
+
+_scheduler: Union[AsyncFairScheduler, None] = None
+
+
+def get_scheduler() -> AsyncFairScheduler:
+    """
+    Returns: (AsyncFairScheduler): the event loop's scheduler, with
+        CTM_ASYNC_FILE_WORKERS slots and at most CTM_ASYNC_FILE_CONCURRENCY per job
+    """
+    global _scheduler  # pylint: disable=global-statement
+    if not _scheduler:
+        _scheduler = AsyncFairScheduler(
+            max(1, int(env.get("CTM_ASYNC_FILE_WORKERS", "64"))),
+            max(1, int(env.get("CTM_ASYNC_FILE_CONCURRENCY", "16"))),
+        )
+    return _scheduler
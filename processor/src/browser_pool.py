@@ -0,0 +1,267 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: A process-wide pool of warm Chrome instances for the slow path, plus the
+    virtual display they run on. Only imported once a job needs the slow path.
+"""
+
+import subprocess
+from contextlib import contextmanager
+from os import environ as env
+from os import path
+from threading import Condition, Lock, Timer
+from time import monotonic, sleep
+from typing import Iterator, List, Union
+
+import selenium.common.exceptions as selex
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from webdriver_manager.chrome import ChromeDriverManager
+
+
+class VirtualDisplay:
+    """
+    An Xvfb server for Chrome to draw on, started when the first browser needs it
+    Args: number (int): the X display number to take
+    """
+
+    def __init__(self, number: int = 99):
+        self._number = number
+        self._lock = Lock()
+        self._proc: Union[subprocess.Popen, None] = None
+
+    def start(self) -> None:
+        """Starts Xvfb unless it is already running, and waits for it to come up"""
+        with self._lock:
+            if self._proc and self._proc.poll() is None:
+                return
+            print("Starting virtual display")
+            self._proc = subprocess.Popen(  # pylint: disable=consider-using-with
+                ["Xvfb", "-ac", f":{self._number}", "-screen", "0", "1280x1024x16"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            env["DISPLAY"] = f":{self._number}"
+            socket = f"/tmp/.X11-unix/X{self._number}"
+            deadline = monotonic() + 5
+            while not path.exists(socket) and monotonic() < deadline:
+                sleep(0.05)
+
+    def stop(self) -> None:
+        """Stops Xvfb if it is running"""
+        with self._lock:
+            if not self._proc:
+                return
+            print("Stopping virtual display")
+            self._proc.terminate()
+            try:
+                self._proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+            self._proc = None
+
+
+class BrowserPool:
+    """
+    Keeps up to `max_size` Chrome instances alive between jobs. Each job leases one,
+        gets its own download directory through CDP, and hands it back reset to a
+        single blank tab. Unhealthy browsers are quit and replaced. Once no browser
+        has been leased for `idle_secs`, every browser and the display are stopped
+        until the next slow job.
+    Args:
+        max_size (int): the most browsers that may be alive at once
+        idle_secs (float): how long the pool may sit unused, 0 to never stop it
+        headless (bool): run Chrome headless instead of on a virtual display
+    """
+
+    def __init__(self, max_size: int, idle_secs: float, headless: bool):
+        self._max_size = max_size
+        self._idle_secs = idle_secs
+        self._headless = headless
+        self._display = VirtualDisplay()
+        self._cond = Condition()
+        self._idle: List[webdriver.Chrome] = []
+        self._alive = 0
+        self._leased = 0
+        self._reaper: Union[Timer, None] = None
+        self._driver_path: Union[str, None] = None
+        self._install_lock = Lock()
+
+    def _service(self) -> Service:
+        """Returns: (Service): a chromedriver service, installing the driver only once"""
+        with self._install_lock:
+            if not self._driver_path:
+                self._driver_path = ChromeDriverManager().install()
+        return Service(self._driver_path)
+
+    def _create(self) -> webdriver.Chrome:
+        """Returns: (Chrome): a freshly started browser"""
+        options = Options()
+        if self._headless:
+            options.add_argument("--headless=new")
+        else:
+            self._display.start()
+        options.add_argument("--no-sandbox")
+        options.add_argument("--ignore-ssl-errors=yes")
+        options.add_argument("--ignore-certificate-errors")
+        options.add_argument("--disable-dev-shm-usage")
+        options.add_experimental_option("excludeSwitches", ["enable-logging"])
+        options.add_experimental_option(
+            "prefs",
+            {
+                "download.prompt_for_download": False,
+                "download.directory_upgrade": True,
+                "safebrowsing.enabled": True,
+            },
+        )
+        return webdriver.Chrome(service=self._service(), options=options)
+
+    @staticmethod
+    def _healthy(driver: webdriver.Chrome) -> bool:
+        """Returns: (bool): True if the browser still responds to commands"""
+        try:
+            return bool(driver.window_handles)
+        except selex.WebDriverException:
+            return False
+
+    @staticmethod
+    def _quit(driver: webdriver.Chrome) -> None:
+        """Quits a browser, ignoring one that's already gone"""
+        try:
+            driver.quit()
+        except selex.WebDriverException:
+            pass
+
+    def prewarm(self, count: int) -> None:
+        """
+        Starts browsers ahead of time so the first slow job doesn't wait on Chrome
+        Args: count (int): how many browsers to have idle, capped at the pool size
+        """
+        while True:
+            with self._cond:
+                if self._alive >= min(count, self._max_size):
+                    return
+                self._alive += 1
+            try:
+                driver = self._create()
+            except selex.WebDriverException as exc:
+                print(f"Failed to prewarm a browser:\n{exc}")
+                with self._cond:
+                    self._alive -= 1
+                return
+            with self._cond:
+                self._idle.append(driver)
+                self._cond.notify()
+                self._schedule_reap()
+
+    def _schedule_reap(self) -> None:
+        """Arms the idle timer while nothing is leased, must hold `_cond`"""
+        if self._idle_secs and not self._leased and not self._reaper:
+            self._reaper = Timer(self._idle_secs, self._reap)
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def _reap(self) -> None:
+        """Stops every browser and the display after the pool sat unused"""
+        with self._cond:  # Held throughout, so no lease can start mid-shutdown
+            self._reaper = None
+            if self._leased:
+                return
+            print("Browser pool idle, shutting it down")
+            self.shutdown()
+
+    def _acquire(self) -> webdriver.Chrome:
+        """Returns: (Chrome): an idle healthy browser, or a new one if there's room"""
+        with self._cond:
+            if self._reaper:
+                self._reaper.cancel()
+                self._reaper = None
+            self._leased += 1
+            self._cond.wait_for(lambda: self._idle or self._alive < self._max_size)
+            if self._idle:
+                driver = self._idle.pop()
+                if self._healthy(driver):
+                    return driver
+                self._quit(driver)
+            else:
+                self._alive += 1
+
+        try:
+            return self._create()
+        except Exception:
+            with self._cond:
+                self._alive -= 1
+                self._leased -= 1
+                self._cond.notify()
+                self._schedule_reap()
+            raise
+
+    def _release(self, driver: webdriver.Chrome) -> None:
+        """Resets a browser to a single blank tab and returns it to the pool"""
+        try:
+            handles = driver.window_handles
+            for handle in handles[1:]:
+                driver.switch_to.window(handle)
+                driver.close()
+            driver.switch_to.window(handles[0])
+            driver.get("about:blank")
+        except selex.WebDriverException:
+            self._quit(driver)
+            with self._cond:
+                self._alive -= 1
+                self._leased -= 1
+                self._cond.notify()
+                self._schedule_reap()
+            return
+
+        with self._cond:
+            self._idle.append(driver)
+            self._leased -= 1
+            self._cond.notify()
+            self._schedule_reap()
+
+    @contextmanager
+    def lease(self, download_dir: str) -> Iterator[webdriver.Chrome]:
+        """
+        Leases a browser for the duration of a job
+        Args: download_dir (str): the absolute path downloads should be saved to
+        Returns: (Iterator[Chrome]): the browser, which goes back to the pool afterwards
+        """
+        driver = self._acquire()
+        try:
+            driver.execute_cdp_cmd(
+                "Browser.setDownloadBehavior",
+                {"behavior": "allow", "downloadPath": download_dir},
+            )
+            yield driver
+        finally:
+            self._release(driver)
+
+    def shutdown(self) -> None:
+        """Quits every idle browser, and the display once no browser is left"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._alive -= len(idle)
+            stop_display = not self._alive
+        for driver in idle:
+            self._quit(driver)
+        if stop_display:
+            self._display.stop()
+
+
+_pool: Union[BrowserPool, None] = None
+_pool_lock = Lock()
+
+
+def get_pool() -> BrowserPool:
+    """Returns: (BrowserPool): the process-wide pool, sized by CTM_BROWSER_POOL_SIZE"""
+    global _pool  # pylint: disable=global-statement
+    with _pool_lock:
+        if not _pool:
+            _pool = BrowserPool(
+                max(1, int(env.get("CTM_BROWSER_POOL_SIZE", "2"))),
+                float(env.get("CTM_BROWSER_IDLE_SECS", "300")),
+                env.get("CTM_HEADLESS", "0") == "1",
+            )
+        return _pool
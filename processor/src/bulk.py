@@ -0,0 +1,148 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: Bulk mode - migrates every project in a plan file as one run, without
+    the Management API, sharing the HTTP sessions, caches, jar store and browser
+    pool between projects
+"""
+
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from os import environ as env
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, List, Union
+
+from common import Job, Status
+
+
+@dataclass
+class ProjectReport:
+    """How a single project in a bulk run went"""
+
+    curseforge_slug: str
+    modrinth_id: str
+    job_id: str
+    status: str = Status.ENQUEUED.name
+    seconds: float = 0.0
+    logs: List[str] = field(default_factory=list)
+
+
+class BulkHelper:
+    """
+    Stands in for MgmtApiHelper during a bulk run, keeping each project's logs and
+        status in its report and echoing the logs to stdout
+    Args: reports (Dict[str, ProjectReport]): the reports, keyed by job id
+    """
+
+    def __init__(self, reports: Dict[str, ProjectReport]):
+        self._reports = reports
+        self._lock = Lock()
+
+    def update_job_status(self, job_id: str, status: Status) -> None:
+        """Records a project's status in its report"""
+        with self._lock:
+            self._reports[job_id].status = status.name
+
+    def append_job_log(self, job_id: str, newlog: str) -> None:
+        """Records a project's log in its report and prints it"""
+        with self._lock:
+            report = self._reports[job_id]
+            report.logs.append(newlog)
+        print(f"[{report.curseforge_slug}] {newlog}")
+
+    def flush(self) -> None:
+        """Nothing is buffered in a bulk run"""
+
+
+def bulk_job_id(slug: str, modrinth_id: str) -> str:
+    """
+    Args:
+        slug (str): the CurseForge slug
+        modrinth_id (str): the Modrinth project id
+    Returns: (str): a job id which is stable between runs of the same plan, so an
+        interrupted run picks up from its journals
+    """
+    return re.sub(r"[^A-Za-z0-9_-]", "_", f"bulk-{slug}-{modrinth_id}")
+
+
+def load_plan(plan_path: str) -> List[Job]:
+    """
+    Reads a plan file - JSON shaped like
+        {"token": "...", "projects": [{"slug": "...", "modrinth_id": "..."}]}
+        where the Modrinth token may instead come from MODRINTH_TOKEN
+    Args: plan_path (str): the plan file
+    Returns: (List[Job]): a job per project
+    """
+    with open(plan_path, "r", encoding="utf-8") as plan_file:
+        plan = json.load(plan_file)
+
+    token = plan.get("token") or env.get("MODRINTH_TOKEN")
+    if not token:
+        raise ValueError("The plan needs a token, or MODRINTH_TOKEN must be set")
+
+    return [
+        Job(
+            oauth_token=token,
+            curseforge_slug=project["slug"],
+            modrinth_id=project["modrinth_id"],
+            job_id=bulk_job_id(project["slug"], project["modrinth_id"]),
+        )
+        for project in plan["projects"]
+    ]
+
+
+def run_plan(
+    jobs: List[Job],
+    process_job: Callable[[BulkHelper, Job], Union[Status, None]],
+    concurrency: int,
+) -> List[ProjectReport]:
+    """
+    Migrates every project in a plan, `concurrency` projects at a time
+    Args:
+        jobs (List[Job]): the plan's jobs, see `load_plan`
+        process_job (Callable[[BulkHelper, Job], Status]): migrates a single job and
+            returns its outcome
+        concurrency (int): how many projects may run at once
+    Returns: (List[ProjectReport]): a report per project, in plan order
+    """
+    reports = {
+        job.job_id: ProjectReport(job.curseforge_slug, job.modrinth_id, job.job_id)
+        for job in jobs
+    }
+    helper = BulkHelper(reports)
+
+    def run(job: Job) -> None:
+        started = monotonic()
+        try:
+            status = process_job(helper, job)
+            reports[job.job_id].status = status.name if status else Status.FAIL.name
+        except Exception as exc:  # pylint: disable=broad-except
+            helper.append_job_log(job.job_id, f"🔥 Crashed: {exc}")
+            reports[job.job_id].status = "CRASHED"
+        reports[job.job_id].seconds = round(monotonic() - started, 2)
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, concurrency), thread_name_prefix="bulk"
+    ) as pool:
+        list(pool.map(run, jobs))
+    return [reports[job.job_id] for job in jobs]
+
+
+def write_report(reports: List[ProjectReport], report_path: Union[str, None]) -> None:
+    """
+    Prints a one-line-per-project summary, and writes the full report as JSON
+    Args:
+        reports (List[ProjectReport]): the finished projects
+        report_path (Union[str, None]): where the JSON report goes, if anywhere
+    """
+    width = max((len(x.curseforge_slug) for x in reports), default=0)
+    for report in reports:
+        print(
+            f"{report.curseforge_slug:<{width}}  {report.status:<12}  {report.seconds:>8.1f}s"
+        )
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as out:
+            json.dump([asdict(x) for x in reports], out, indent=2)
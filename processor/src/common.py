@@ -5,7 +5,7 @@ Author: oitsjustjose @ modrinth/curseforge/twitter
 
 from dataclasses import dataclass
 from enum import Enum
-from typing import List
+from typing import List, Union
 
 
 class Status(Enum):
@@ -31,14 +31,25 @@ class Job:
     logs: str = ""
     status: Status = Status.ENQUEUED
     queue_place: int = 0
-
-
-@dataclass
-class ModInfo:
-    """Stores metadata about a jarfile to be extrapolated"""
-
-    mod_version: str
-    modrinth_name: str
+    enqueued_at: str = ""
+    profile: bool = False
+
+
+@dataclass(slots=True)
+class ModFile:
+    """
+    The parts of a CurseForge file record that a migration needs, with the Modrinth
+        version number, game versions and loaders worked out once at parse time
+    """
+
+    file_id: int
+    file_name: str
+    display_name: str
+    download_url: str  # empty if Curse does not allow third-party downloads
+    is_available: bool
+    release_type: int
+    file_length: int  # 0 if unknown
+    sha1: Union[str, None]  # None if Curse did not give one
+    version_number: str
+    game_versions: List[str]
     loaders: List[str]
-    game_version: str  # representative game ver
-    game_versions: List[str]  # actual game vers
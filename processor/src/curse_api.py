@@ -5,23 +5,39 @@
 """
 
 import re
+from concurrent.futures import Future, ThreadPoolExecutor
 from os import environ as env
-from typing import Callable, List, Tuple, Union
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
 
 import requests
 
+from common import ModFile
+from curse_cache import FILES_TTL, SLUG_TTL, get_cache
+from http_client import CURSE_API, curse_session
+from metrics import stage
+from scheduler import FairScheduler
+
+FALLBACK_CHANGELOG = (
+    "Automagically migrated from CurseForge via https://ctm.oitsjustjose.com"
+)
+
 
 def get_modid(slug: str, logmsg: Callable[[str], None]) -> Union[str, None]:
     """
     Gets the ModID for this job
     Returns (str): the mod name if any
     """
+    cache = get_cache()
+    if cache and (mod_id := cache.get(f"slug:{slug}")):
+        return mod_id
+
     try:
-        response = requests.get(
-            f"https://api.curseforge.com/v1/mods/search?gameId=432&slug={slug}",
-            headers={"x-api-key": env["CURSE_API_KEY"]},
-            timeout=30,
-        )
+        with stage("slug_lookup"):
+            response = curse_session().get(
+                f"{CURSE_API}/v1/mods/search?gameId=432&slug={slug}",
+                timeout=30,
+            )
         if not response.ok:
             logmsg(f"🔥 Failed to get mod_id for {slug}.")
             return None
@@ -29,6 +45,8 @@ def get_modid(slug: str, logmsg: Callable[[str], None]) -> Union[str, None]:
         response_json = response.json()
         try:
             mod_id = response_json["data"][0]["id"]
+            if cache:
+                cache.put(f"slug:{slug}", mod_id, SLUG_TTL)
             return mod_id
         except IndexError:
             logmsg(f"🔥 Failed to get mod_id for {slug}")
@@ -38,41 +56,225 @@ def get_modid(slug: str, logmsg: Callable[[str], None]) -> Union[str, None]:
         return None
 
 
-def get_pages(mod_id: str, logmsg: Callable[[str], None]) -> Tuple[int, int]:
-    """
-    Gets the number of pages and the item count of the final page for the mod
-    Returns (Tuple[int, int]): (-1,-1) on failure, values above otherwise
-    """
-    try:
-        response = requests.get(
-            f"https://api.curseforge.com/v1/mods/{mod_id}/files",
-            headers={"x-api-key": env["CURSE_API_KEY"]},
-            timeout=30,
-        )
-        data = response.json()["pagination"]
-        num_pages = data["totalCount"] // data["pageSize"]
-        last_page_size = data["totalCount"] % data["pageSize"]
-        return num_pages, last_page_size
-    except TimeoutError:
-        logmsg("🕜 Timed out getting mod list")
-        return -1, -1
-
-
 def get_changelog(mod_id: str, file_id: str) -> str:
     """
     Gets the changelog from Curse for a given File ID.
     Args: file_id (str): the File ID in question
     Returns: (str): the changelog or a reasonable fallback
     """
+    # Changelogs never change for a published file, so they never expire
+    cache = get_cache()
+    if cache and (changelog := cache.get(f"changelog:{mod_id}:{file_id}")) is not None:
+        return changelog
+
     try:
-        response = requests.get(
-            f"https://api.curseforge.com/v1/mods/{mod_id}/files/{file_id}/changelog",
-            headers={"x-api-key": env["CURSE_API_KEY"]},
-            timeout=30,
-        )
-        return response.json()["data"]
+        with stage("changelog"):
+            response = curse_session().get(
+                f"{CURSE_API}/v1/mods/{mod_id}/files/{file_id}/changelog",
+                timeout=30,
+            )
+        changelog = response.json()["data"]
+        if cache:
+            cache.put(f"changelog:{mod_id}:{file_id}", changelog)
+        return changelog
     except TimeoutError:
-        return "Automagically migrated from CurseForge via https://ctm.oitsjustjose.com"
+        return FALLBACK_CHANGELOG
+
+
+_prefetcher: Union[FairScheduler, None] = None
+_prefetcher_lock = Lock()
+
+
+def get_prefetcher() -> FairScheduler:
+    """
+    Returns: (FairScheduler): the process-wide changelog prefetcher, with
+        CTM_CHANGELOG_PREFETCH workers which take turns between mods
+    """
+    global _prefetcher  # pylint: disable=global-statement
+    with _prefetcher_lock:
+        if not _prefetcher:
+            workers = max(1, int(env.get("CTM_CHANGELOG_PREFETCH", "8")))
+            _prefetcher = FairScheduler(workers, max(1, workers // 2))
+        return _prefetcher
+
+
+class CurseClient:
+    """
+    A per-job CurseForge client which resolves the slug once and memoizes file
+        listings, so each listing is fetched at most once per job
+    Args:
+        slug (str): the CurseForge slug for the job
+        logmsg (Callable[[str], None]): where to log failures to
+    """
+
+    def __init__(self, slug: str, logmsg: Callable[[str], None]):
+        self.slug = slug
+        self._logmsg = logmsg
+        self._lock = Lock()
+        self._modid: Union[str, None] = None
+        self._modid_resolved = False
+        self._files: Dict[Tuple[int, Union[int, None]], Dict] = {}
+        self._changelogs: Dict[int, Future] = {}
+
+    @property
+    def mod_id(self) -> Union[str, None]:
+        """Returns: (Union[str, None]): the mod id for the slug, resolved on first use"""
+        with self._lock:
+            if not self._modid_resolved:
+                self._modid = get_modid(self.slug, self._logmsg)
+                self._modid_resolved = True
+            return self._modid
+
+    def seed(
+        self,
+        mod_id: Union[str, None],
+        listings: Dict[Tuple[int, Union[int, None]], Dict],
+    ) -> None:
+        """
+        Hands over a mod id and listings which were already fetched for this job,
+            e.g. by its AsyncCurseClient, so they are not fetched a second time
+        Args:
+            mod_id (Union[str, None]): the resolved mod id, None if it did not resolve
+            listings (Dict[Tuple[int, Union[int, None]], Dict]): parsed listings,
+                keyed by (index, page_size)
+        """
+        with self._lock:
+            self._modid, self._modid_resolved = mod_id, True
+            self._files.update(listings)
+
+    def get_files(
+        self, index: int = 0, page_size: Union[int, None] = None
+    ) -> Union[Dict, None]:
+        """
+        Gets a single listing of the mod's files, memoized per (index, page_size)
+        Args:
+            index (int): the index query param
+            page_size (int): the pageSize query param, or None for Curse's default
+        Returns: (Union[Dict, None]): the JSON payload from /files with its `data`
+            parsed into ModFiles, None on failure
+        """
+        key = (index, page_size)
+        with self._lock:
+            if key in self._files:
+                return self._files[key]
+
+        cache = get_cache()
+        cache_key = f"files:{self.mod_id}:{index}:{page_size}"
+        if not (cache and (listing := cache.get(cache_key))):
+            params = {"index": index} if index else {}
+            if page_size is not None:
+                params["pageSize"] = page_size
+
+            with stage("enumerate"):
+                response = curse_session().get(
+                    f"{CURSE_API}/v1/mods/{self.mod_id}/files",
+                    params=params,
+                    timeout=30,
+                )
+            if not response.ok:
+                return None
+
+            listing = response.json()
+            if cache:
+                cache.put(cache_key, listing, FILES_TTL)
+
+        parsed = parse_listing(listing)
+        with self._lock:
+            self._files[key] = parsed
+            return parsed
+
+    def get_file_count(self) -> int:
+        """
+        Gets the total number of files the mod has
+        Returns (int): -1 on failure, the file count otherwise
+        """
+        try:
+            listing = self.get_files()
+            if not listing:
+                self._logmsg("🔥 Failed to get mod list")
+                return -1
+            return listing["pagination"]["totalCount"]
+        except (TimeoutError, requests.exceptions.RequestException):
+            self._logmsg("🕜 Timed out getting mod list")
+            return -1
+
+    def iter_files(self) -> Iterator[ModFile]:
+        """
+        Yields every file record for the mod in listing order. The first listing
+            tells us how many files there are, then the rest are fetched by item
+            `index` in the background, CTM_PAGE_PREFETCH at a time, so callers
+            only ever wait on the first round trip.
+        Returns: (Iterator[ModFile]): each file from /files
+        """
+        first = self.get_files()
+        if not first:
+            self._logmsg("🔥 Failed to get mod list")
+            return
+
+        page_size = first["pagination"]["pageSize"]
+        total = first["pagination"]["totalCount"]
+        workers = max(1, int(env.get("CTM_PAGE_PREFETCH", "4")))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = [
+                (idx, pool.submit(self.get_files, idx, page_size))
+                for idx in range(page_size, total, page_size)
+            ]
+            yield from first["data"]
+            for idx, future in pending:
+                try:
+                    listing = future.result()
+                except (TimeoutError, requests.exceptions.RequestException):
+                    listing = None
+                if not listing:
+                    self._logmsg(
+                        f"🕜 Failed to list files {idx}-{idx + page_size} for {self.slug} ({self.mod_id})"
+                    )
+                    continue
+                yield from listing["data"]
+
+    def prefetch_changelog(self, file_id: int) -> None:
+        """
+        Starts fetching a file's changelog in the background, so it is ready by the
+            time the file is uploaded. Curse has no batch endpoint for changelogs,
+            so this is what keeps them off the upload path.
+        Args: file_id (int): the File ID in question
+        """
+        mod_id = self.mod_id
+        with self._lock:
+            if file_id not in self._changelogs:
+                self._changelogs[file_id] = get_prefetcher().submit(
+                    self.slug, get_changelog, mod_id, file_id
+                )
+
+    def prefetch_changelogs(self, mods: Iterable[ModFile]) -> Iterator[ModFile]:
+        """
+        Passes files through, prefetching each one's changelog as it goes by
+        Args: mods (Iterable[ModFile]): the files about to be uploaded
+        Returns: (Iterator[ModFile]): the same files
+        """
+        for mod in mods:
+            self.prefetch_changelog(mod.file_id)
+            yield mod
+
+    def cancel_prefetch(self) -> None:
+        """Drops any prefetched changelogs which were never asked for"""
+        with self._lock:
+            for future in self._changelogs.values():
+                future.cancel()
+            self._changelogs.clear()
+
+    def get_changelog(self, file_id: int) -> str:
+        """
+        Gets the changelog from Curse for a given File ID of this mod, prefetched
+            if it can be
+        Args: file_id (int): the File ID in question
+        Returns: (str): the changelog or a reasonable fallback
+        """
+        with self._lock:
+            future = self._changelogs.pop(file_id, None)
+        if future:
+            return future.result()
+        return get_changelog(self.mod_id, file_id)
 
 
 # region NON-API-CALL FUNCTIONS
@@ -112,4 +314,50 @@ def get_version(file_name: str) -> str:
     return ver
 
 
+def get_sha1(mod: Dict) -> Union[str, None]:
+    """
+    Gets the sha1 Curse advertises for a file
+    Args: mod (Dict): a single file record from /files
+    Returns: (Union[str, None]): the hex digest, None if Curse did not give one
+    """
+    for entry in mod.get("hashes", []):
+        if entry["algo"] == 1:  # 1 is sha1, 2 is md5
+            return entry["value"]
+    return None
+
+
+def parse_file(mod: Dict) -> ModFile:
+    """
+    Keeps only what a migration needs from a file record, so the rest of the JSON
+        (modules, dependencies, sortable game versions..) can be freed right away
+    Args: mod (Dict): a single file record from /files
+    Returns: (ModFile): the compact record
+    """
+    game_versions, loaders = get_loader_info(mod["gameVersions"])
+    return ModFile(
+        file_id=mod["id"],
+        file_name=mod["fileName"],
+        display_name=mod["displayName"],
+        download_url=mod.get("downloadUrl") or "",
+        is_available=mod["isAvailable"],
+        release_type=mod["releaseType"],
+        file_length=mod.get("fileLength") or 0,
+        sha1=get_sha1(mod),
+        version_number=get_version(mod["displayName"]),
+        game_versions=game_versions,
+        loaders=loaders,
+    )
+
+
+def parse_listing(listing: Dict) -> Dict:
+    """
+    Args: listing (Dict): the JSON payload from /files
+    Returns: (Dict): the payload's pagination, with its `data` parsed into ModFiles
+    """
+    return {
+        "pagination": listing["pagination"],
+        "data": [parse_file(x) for x in listing["data"]],
+    }
+
+
 # endregion NON-API-CALL FUNCTIONS
@@ -0,0 +1,135 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: An optional on-disk cache for CurseForge metadata so re-runs skip the API
+"""
+
+import json
+import sqlite3
+from os import environ as env
+from threading import Lock
+from time import time
+from typing import Any, Union
+
+SLUG_TTL = float(env.get("CTM_CACHE_SLUG_TTL", str(60 * 60 * 24)))
+FILES_TTL = float(env.get("CTM_CACHE_FILES_TTL", str(60 * 60)))
+
+
+class CurseCache:
+    """
+    A SQLite-backed key/value store with per-entry TTLs and LRU eviction once the
+        stored values grow past a byte budget
+    Args:
+        db_path (str): where the SQLite database lives
+        max_bytes (int): the budget for stored values before the LRU are evicted
+    """
+
+    def __init__(self, db_path: str, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires REAL,
+                accessed REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Union[Any, None]:
+        """
+        Gets a value from the cache if it is present and has not expired
+        Args: key (str): the key to look up
+        Returns: (Union[Any, None]): the cached value, None on a miss
+        """
+        now = time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if not row or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, value: Any, ttl: Union[float, None] = None) -> None:
+        """
+        Stores a value in the cache, evicting the least recently used if over budget
+        Args:
+            key (str): the key to store under
+            value (Any): a JSON-serializable value
+            ttl (Union[float, None]): seconds until the value expires, None for never
+        """
+        now = time()
+        data = json.dumps(value)
+        with self._lock:
+            self._conn.execute(
+                "REPLACE INTO entries (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now + ttl if ttl is not None else None, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        """Drops expired entries, then the least recently used until under budget"""
+        self._conn.execute(
+            "DELETE FROM entries WHERE expires IS NOT NULL AND expires < ?", (time(),)
+        )
+        (total,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        if total <= self._max_bytes:
+            return
+
+        rows = self._conn.execute(
+            "SELECT key, size FROM entries ORDER BY accessed ASC"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self._max_bytes:
+                break
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self) -> str:
+        """Returns: (str): a human-readable summary of the hit/miss counters"""
+        lookups = self.hits + self.misses
+        ratio = (self.hits / lookups * 100) if lookups else 0
+        return f"{self.hits} hits / {self.misses} misses ({ratio:.1f}% hit rate)"
+
+
+_cache: Union[CurseCache, None] = None
+_cache_lock = Lock()
+
+
+def get_cache() -> Union[CurseCache, None]:
+    """
+    Gets the process-wide cache, opening it on first use
+    Returns: (Union[CurseCache, None]): the cache, None if CTM_CACHE_PATH is not set
+    """
+    global _cache  # pylint: disable=global-statement
+    if "CTM_CACHE_PATH" not in env:
+        return None
+
+    with _cache_lock:
+        if not _cache:
+            _cache = CurseCache(
+                env["CTM_CACHE_PATH"],
+                int(env.get("CTM_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+            )
+        return _cache
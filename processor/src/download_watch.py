@@ -0,0 +1,66 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: Watches Chrome's download directory so the slow path waits exactly as
+    long as a download actually takes
+"""
+
+from os import path, scandir
+from time import monotonic, sleep
+from typing import Tuple
+
+PARTIAL_SUFFIX = ".crdownload"
+MIN_RATE = 128 * 1024  # bytes/sec we're willing to wait for before giving up
+BASE_TIMEOUT = 20.0
+STALL_TIMEOUT = 30.0
+
+
+def _dir_state(directory: str) -> Tuple[bool, int]:
+    """
+    Takes a cheap snapshot of a download directory
+    Args: directory (str): the directory Chrome downloads into
+    Returns: (Tuple[bool, int]): (whether any partial downloads remain, total bytes on disk)
+    """
+    partial, total = False, 0
+    with scandir(directory) as entries:
+        for entry in entries:
+            partial = partial or entry.name.endswith(PARTIAL_SUFFIX)
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:  # Chrome renamed it out from under us
+                continue
+    return partial, total
+
+
+def wait_for_download(directory: str, file_name: str, expected_size: int = 0) -> bool:
+    """
+    Waits for Chrome to finish downloading a file: the file must exist (with the
+        expected size, if known) and no .crdownload partial may remain. Gives up
+        after a timeout scaled by the expected size, or once nothing has grown for
+        STALL_TIMEOUT seconds.
+    Args:
+        directory (str): the directory Chrome downloads into
+        file_name (str): the name the finished download will have
+        expected_size (int): the size Curse reports for the file, 0 if unknown
+    Returns: (bool): True once the download is complete, False if it timed out
+    """
+    target = path.join(directory, file_name)
+    timeout = BASE_TIMEOUT + expected_size / MIN_RATE
+    start = last_growth = monotonic()
+    last_total, interval = -1, 0.05
+
+    while (now := monotonic()) - start < timeout:
+        partial, total = _dir_state(directory)
+        if not partial and path.exists(target):
+            if not expected_size or path.getsize(target) == expected_size:
+                return True
+
+        if total != last_total:
+            last_total, last_growth = total, now
+        elif now - last_growth > STALL_TIMEOUT:
+            return False
+
+        sleep(interval)
+        interval = min(interval * 2, 0.5)
+
+    return False
@@ -0,0 +1,102 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: Shared, pooled HTTP sessions so connections are kept alive between calls
+"""
+
+from os import environ as env
+from threading import Lock
+from time import sleep
+from typing import Dict, Union
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import retried
+from rate_limit import limiter_for
+
+CURSE_API = env.get("CTM_CURSE_API", "https://api.curseforge.com")
+MODRINTH_API = env.get("CTM_MODRINTH_API", "https://api.modrinth.com")
+USER_AGENT = "oitsjustjose/Curse-To-Modrinth-Migrator (ctm.oitsjustjose.com)"
+
+_sessions: Dict[str, requests.Session] = {}
+_lock = Lock()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    An adapter which sends every request through its host's rate limiter. Requests
+        that can be replayed are retried on a 429 - streamed uploads cannot be, so
+        their 429 is handed back for the caller to retry.
+    """
+
+    MAX_RETRIES = 5
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        limiter = limiter_for(request.url)
+        replayable = request.body is None or isinstance(request.body, (bytes, str))
+        attempt = 0
+        while True:
+            sleep(limiter.reserve())
+            response = super().send(request, **kwargs)
+            limiter.observe(response.status_code, response.headers)
+            if response.status_code != 429 or not replayable:
+                return response
+            attempt += 1
+            if attempt >= self.MAX_RETRIES:
+                return response
+            retried(request.url)
+            response.close()
+
+
+def session_for(
+    url: str,
+    headers: Union[Dict[str, str], None] = None,
+    params: Union[Dict[str, str], None] = None,
+) -> requests.Session:
+    """
+    Gets the pooled session for the host `url` points at, creating it on first use
+    Args:
+        url (str): any url on the host in question
+        headers (Dict[str, str]): default headers, only applied when created
+        params (Dict[str, str]): default query params, only applied when created
+    Returns: (Session): the session shared by everything talking to that host
+    """
+    host = urlparse(url).netloc
+    with _lock:
+        if host in _sessions:
+            return _sessions[host]
+
+        pool_size = int(env.get("CTM_POOL_SIZE", "16"))
+        adapter = RateLimitedAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"User-Agent": USER_AGENT, **(headers or {})})
+        session.params.update(params or {})
+        _sessions[host] = session
+        return session
+
+
+def curse_session() -> requests.Session:
+    """Returns: (Session): the CurseForge API session, with the API key attached"""
+    return session_for(CURSE_API, headers={"x-api-key": env["CURSE_API_KEY"]})
+
+
+def modrinth_session() -> requests.Session:
+    """Returns: (Session): the Modrinth API session"""
+    return session_for(MODRINTH_API)
+
+
+def mgmt_session() -> requests.Session:
+    """Returns: (Session): the Management API session, with the mgmt key attached"""
+    return session_for(env["MGMT_HOST"], params={"mgmtKey": env["MGMT_KEY"]})
+
+
+def close_all() -> None:
+    """Closes every pooled session, dropping their kept-alive connections"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,209 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: An optional content-addressed store for downloaded jars so re-runs and
+    retries never download the same bytes twice
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import environ as env
+from os import makedirs, path, replace, scandir, utime
+from os import unlink as rm
+from threading import Lock
+from typing import AsyncIterable, BinaryIO, Iterable, Iterator, Union
+from uuid import uuid4
+
+from common import ModFile
+from streaming import HashedChunks, TeeChunks
+
+PARTIAL_SUFFIX = ".part"
+
+
+class _Unverified(Exception):
+    """Abandons a blob whose jar never finished streaming past"""
+
+
+class JarStore:
+    """
+    Jars on disk keyed by CurseForge file id and sha1, evicting the least recently
+        used once they grow past a byte budget. Blobs are written to a temporary
+        file and renamed into place, so a blob is either complete or absent.
+    Args:
+        root (str): the directory the blobs live in
+        max_bytes (int): the budget for stored jars before the LRU are evicted
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self._root = path.realpath(root)
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+        self._blobs: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        makedirs(self._root, exist_ok=True)
+        found = []
+        for shard in scandir(self._root):
+            if not shard.is_dir():
+                continue
+            for blob in scandir(shard.path):
+                if blob.name.endswith(PARTIAL_SUFFIX):
+                    rm(blob.path)  # Left behind by a crash mid-download
+                    continue
+                stat = blob.stat()
+                found.append((stat.st_mtime, blob.path, stat.st_size))
+        for _, blob_path, size in sorted(found):
+            self._blobs[blob_path] = size
+            self._bytes += size
+
+    def _path_for(self, mod: ModFile) -> Union[str, None]:
+        """
+        Args: mod (ModFile): a single file from Curse's /files
+        Returns: (Union[str, None]): where the jar's blob lives, None if Curse gave
+            no sha1 to address it by
+        """
+        if not mod.sha1:
+            return None
+        return path.join(self._root, mod.sha1[:2], f"{mod.file_id}-{mod.sha1}.jar")
+
+    def accepts(self, mod: ModFile) -> bool:
+        """
+        Args: mod (ModFile): a single file from Curse's /files
+        Returns: (bool): True if the jar can be stored
+        """
+        return self._path_for(mod) is not None
+
+    def open_blob(self, mod: ModFile) -> Union[BinaryIO, None]:
+        """
+        Opens a jar's blob for reading, marking it as recently used. An open blob
+            stays readable even if it is evicted while in use, so callers should
+            hold on to it rather than checking for the blob and opening it later.
+        Args: mod (ModFile): a single file from Curse's /files
+        Returns: (Union[BinaryIO, None]): the open blob, None if it is not stored
+        """
+        blob_path = self._path_for(mod)
+        with self._lock:
+            if blob_path not in self._blobs:
+                self.misses += 1
+                return None
+            self._touch(blob_path)
+            self.hits += 1
+            return open(blob_path, "rb")  # pylint: disable=consider-using-with
+
+    @contextmanager
+    def writer(self, mod: ModFile) -> Iterator[BinaryIO]:
+        """
+        Opens a temporary file which becomes the jar's blob once the block exits
+            cleanly, and is thrown away if it raises
+        Args: mod (ModFile): a single file from Curse's /files, see `accepts`
+        Returns: (Iterator[BinaryIO]): the file to write the jar into
+        """
+        blob_path = self._path_for(mod)
+        partial = f"{blob_path}.{uuid4().hex}{PARTIAL_SUFFIX}"
+        makedirs(path.dirname(blob_path), exist_ok=True)
+        try:
+            with open(partial, "wb") as jar:
+                yield jar
+            self._commit(partial, blob_path)
+        finally:
+            if path.exists(partial):
+                rm(partial)
+
+    def fill(self, mod: ModFile, chunks: Iterable[bytes]) -> BinaryIO:
+        """
+        Writes a jar into its blob and hands the blob back open for reading. It is
+            opened before it is committed, so it stays readable even if another
+            worker's commit evicts it straight away.
+        Args:
+            mod (ModFile): a single file from Curse's /files, see `accepts`
+            chunks (Iterable[bytes]): the jar contents
+        Returns: (BinaryIO): the stored jar, open for reading
+        """
+        pinned = None
+        try:
+            with self.writer(mod) as jar:
+                for chunk in chunks:
+                    jar.write(chunk)
+                jar.flush()
+                pinned = open(jar.name, "rb")  # pylint: disable=consider-using-with
+            return pinned
+        except BaseException:
+            if pinned:
+                pinned.close()
+            raise
+
+    @contextmanager
+    def tee(
+        self, mod: ModFile, chunks: Union[Iterable[bytes], AsyncIterable[bytes]]
+    ) -> Iterator[HashedChunks]:
+        """
+        Copies a jar into its blob as it streams past on its way somewhere else. The
+            blob is only kept if the whole jar went by and matched Curse's sha1.
+        Args:
+            mod (ModFile): a single file from Curse's /files, see `accepts`
+            chunks (Union[Iterable[bytes], AsyncIterable[bytes]]): the jar contents
+        Returns: (Iterator[HashedChunks]): the jar contents, checked against the sha1
+        """
+        try:
+            with self.writer(mod) as blob:
+                hashed = HashedChunks(TeeChunks(chunks, blob), mod.sha1)
+                yield hashed
+                if not hashed.verified:
+                    raise _Unverified()
+        except _Unverified:
+            pass
+
+    def _commit(self, partial: str, blob_path: str) -> None:
+        """Renames a finished temporary file into place and enforces the budget"""
+        size = path.getsize(partial)
+        with self._lock:
+            replace(partial, blob_path)
+            self._bytes += size - self._blobs.pop(blob_path, 0)
+            self._blobs[blob_path] = size
+            self._evict()
+
+    def _touch(self, blob_path: str) -> None:
+        """Marks a blob as the most recently used, on disk too for the next start"""
+        self._blobs.move_to_end(blob_path)
+        utime(blob_path)
+
+    def _evict(self) -> None:
+        """Drops the least recently used blobs until under budget"""
+        while self._bytes > self._max_bytes and len(self._blobs) > 1:
+            blob_path, size = self._blobs.popitem(last=False)
+            self._bytes -= size
+            if path.exists(blob_path):
+                rm(blob_path)
+
+    def stats(self) -> str:
+        """Returns: (str): a human-readable summary of the hit/miss counters"""
+        lookups = self.hits + self.misses
+        ratio = (self.hits / lookups * 100) if lookups else 0
+        return (
+            f"{self.hits} hits / {self.misses} misses ({ratio:.1f}% hit rate), "
+            f"{self._bytes / 1024 / 1024:.1f} MiB stored"
+        )
+
+
+_store: Union[JarStore, None] = None
+_store_lock = Lock()
+
+
+def get_store() -> Union[JarStore, None]:
+    """
+    Gets the process-wide jar store, opening it on first use
+    Returns: (Union[JarStore, None]): the store, None if CTM_JAR_STORE is not set
+    """
+    global _store  # pylint: disable=global-statement
+    if "CTM_JAR_STORE" not in env:
+        return None
+
+    with _store_lock:
+        if not _store:
+            _store = JarStore(
+                env["CTM_JAR_STORE"],
+                int(env.get("CTM_JAR_STORE_MAX_BYTES", str(10 * 1024 * 1024 * 1024))),
+            )
+        return _store
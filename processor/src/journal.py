@@ -0,0 +1,92 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: A per-job checkpoint journal so resumed jobs skip the files they
+    already finished
+"""
+
+import json
+from os import environ as env
+from os import makedirs, path
+from os import unlink as rm
+from threading import Lock
+from typing import Dict, List
+
+from common import ModFile, Status
+
+
+def _journal_path(job_id: str) -> str:
+    """
+    Args: job_id (str): the job's id
+    Returns: (str): where the job's journal lives, under CTM_JOURNAL_DIR
+    """
+    return path.join(env.get("CTM_JOURNAL_DIR", "./journal"), f"{job_id}.jsonl")
+
+
+class JobJournal:
+    """
+    An append-only record of the terminal status of every file in a job, one JSON
+        line per file. Every line is flushed as it is written, so a crashed
+        processor loses at most the files that were in flight.
+    Args: job_id (str): the job's id
+    """
+
+    def __init__(self, job_id: str):
+        self._path = _journal_path(job_id)
+        self._lock = Lock()
+        self._done: Dict[str, Status] = {}
+        self.replayed: List[Status] = []
+
+        if path.exists(self._path):
+            with open(self._path, "r", encoding="utf-8") as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                        self._done[str(entry["id"])] = Status[entry["status"]]
+                    except (ValueError, KeyError):
+                        continue  # A torn write from the crash, that file reruns
+
+        makedirs(path.dirname(self._path), exist_ok=True)
+        self._file = open(  # pylint: disable=consider-using-with
+            self._path, "a", encoding="utf-8"
+        )
+
+    def is_pending(self, mod: ModFile) -> bool:
+        """
+        Args: mod (ModFile): a single file from Curse's /files
+        Returns: (bool): False if an earlier run already finished the file, in which
+            case its status is kept in `replayed`
+        """
+        status = self._done.get(str(mod.file_id))
+        if status is None:
+            return True
+        self.replayed.append(status)
+        return False
+
+    def record(self, file_id: str, status: Status) -> None:
+        """
+        Checkpoints a file's terminal status
+        Args:
+            file_id (str): the CurseForge file id
+            status (Status): SUCCESS or FAIL
+        """
+        line = json.dumps({"id": str(file_id), "status": status.name})
+        with self._lock:
+            if self._file.closed:  # A transfer that finished after its job stopped
+                return
+            self._file.write(f"{line}\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        """Closes the journal, leaving it on disk for the next run"""
+        with self._lock:
+            self._file.close()
+
+
+def discard_journal(job_id: str) -> None:
+    """
+    Removes a job's journal once the job is complete
+    Args: job_id (str): the job's id
+    """
+    if path.exists(_journal_path(job_id)):
+        rm(_journal_path(job_id))
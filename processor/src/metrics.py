@@ -0,0 +1,121 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: Prometheus metrics for the processor, served on /metrics
+"""
+
+from datetime import datetime, timezone
+from os import environ as env
+from os import sysconf
+from time import monotonic
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator
+from urllib.parse import urlparse
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+JOBS = Counter("ctm_jobs", "Jobs finished, by outcome", ["outcome"])
+FILES = Counter(
+    "ctm_files", "Files finished, by provider and status", ["provider", "status"]
+)
+BYTES = Counter("ctm_bytes", "Jar bytes moved, by direction", ["direction"])
+STAGE_SECONDS = Histogram(
+    "ctm_stage_seconds",
+    "Time spent per stage of a migration",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+RETRIES = Counter("ctm_retries", "Requests retried, by host", ["host"])
+QUEUE_WAIT = Histogram(
+    "ctm_queue_wait_seconds",
+    "Time jobs spent enqueued before a processor claimed them",
+    buckets=(1, 5, 15, 30, 60, 300, 900, 1800, 3600, 4 * 3600, 24 * 3600),
+)
+
+COLD_START = Gauge(
+    "ctm_cold_start_seconds", "Time from process start until the first job poll"
+)
+_imported = monotonic()
+
+
+def stage(name: str):
+    """
+    Times a block of work as one of the migration stages
+    Args: name (str): slug_lookup, enumerate, download, changelog, upload or mgmt_patch
+    Returns: (ContextManager): the timer, to be used with `with`
+    """
+    return STAGE_SECONDS.labels(name).time()
+
+
+def downloaded(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Passes a download's chunks through, counting their bytes
+    Args: chunks (Iterable[bytes]): the chunks from the CDN
+    Returns: (Iterator[bytes]): the same chunks
+    """
+    counter = BYTES.labels("downloaded")
+    for chunk in chunks:
+        counter.inc(len(chunk))
+        yield chunk
+
+
+async def downloaded_async(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    The async counterpart to `downloaded`
+    Args: chunks (AsyncIterable[bytes]): the chunks from the CDN
+    Returns: (AsyncIterator[bytes]): the same chunks
+    """
+    counter = BYTES.labels("downloaded")
+    async for chunk in chunks:
+        counter.inc(len(chunk))
+        yield chunk
+
+
+def retried(url: str) -> None:
+    """
+    Counts a retried request against its host
+    Args: url (str): any url on the host in question
+    """
+    RETRIES.labels(urlparse(url).netloc).inc()
+
+
+def claimed(enqueued_at: str) -> None:
+    """
+    Records how long a freshly claimed job sat in the queue
+    Args: enqueued_at (str): the job's ISO 8601 enqueue time, empty if unknown
+    """
+    if not enqueued_at:
+        return
+    enqueued = datetime.fromisoformat(enqueued_at.replace("Z", "+00:00"))
+    QUEUE_WAIT.observe((datetime.now(timezone.utc) - enqueued).total_seconds())
+
+
+def process_age() -> float:
+    """
+    Returns: (float): seconds since the process started, interpreter startup included
+        where /proc has it, otherwise since this module was imported
+    """
+    try:
+        with open("/proc/self/stat", encoding="utf-8") as stat:
+            # The command name can contain spaces, the fields after it cannot
+            started = int(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", encoding="utf-8") as uptime:
+            return float(uptime.read().split()[0]) - started / sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return monotonic() - _imported
+
+
+def ready() -> float:
+    """
+    Records the processor's cold start time, once it is about to poll for jobs
+    Returns: (float): the cold start time in seconds
+    """
+    seconds = process_age()
+    COLD_START.set(seconds)
+    return seconds
+
+
+def serve() -> None:
+    """Serves /metrics on CTM_METRICS_PORT (9100 by default, 0 to turn it off)"""
+    port = int(env.get("CTM_METRICS_PORT", "9100"))
+    if port:
+        start_http_server(port)
@@ -4,12 +4,84 @@ Author: oitsjustjose @ modrinth/curseforge/twitter
 """
 
 from os import environ as env
-from typing import Dict, List, Union
+from threading import Condition, Lock, Thread
+from time import sleep
+from typing import Callable, Dict, List, Tuple, Union
 
 import requests
 from cryptography.fernet import Fernet
 
 from common import Job, Status
+from http_client import mgmt_session
+from metrics import stage
+
+
+class LogSink:
+    """
+    Buffers job logs and status updates, shipping them from a background thread in
+        one batch per job once a job has `max_batch` logs queued or `max_delay`
+        seconds have passed. Only the latest queued status per job is sent.
+    Args:
+        send (Callable): ships a single job's batch as (job_id, logs, status)
+        max_batch (int): how many queued logs for one job trigger an early flush
+        max_delay (float): the longest a queued log or status waits to be shipped
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str, List[str], Union[Status, None]], None],
+        max_batch: int,
+        max_delay: float,
+    ):
+        self._send = send
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._cond = Condition()
+        self._ship_lock = Lock()
+        self._logs: Dict[str, List[str]] = {}
+        self._statuses: Dict[str, Status] = {}
+        Thread(target=self._run, name="log-sink", daemon=True).start()
+
+    def log(self, job_id: str, msg: str) -> None:
+        """Queues a log line for a job"""
+        with self._cond:
+            self._logs.setdefault(job_id, []).append(msg)
+            if len(self._logs[job_id]) >= self._max_batch:
+                self._cond.notify()
+
+    def status(self, job_id: str, status: Status) -> None:
+        """Queues a status update for a job, replacing any not yet shipped"""
+        with self._cond:
+            self._statuses[job_id] = status
+
+    def flush(self) -> None:
+        """Ships everything queued right now, blocking until it has been sent"""
+        with self._ship_lock:
+            with self._cond:
+                logs, statuses = self._drain()
+            self._ship(logs, statuses)
+
+    def _full(self) -> bool:
+        """Returns: (bool): True if any job has a full batch of logs queued"""
+        return any(len(x) >= self._max_batch for x in self._logs.values())
+
+    def _drain(self) -> Tuple[Dict[str, List[str]], Dict[str, Status]]:
+        """Takes everything queued so far, leaving the queues empty"""
+        logs, statuses = self._logs, self._statuses
+        self._logs, self._statuses = {}, {}
+        return logs, statuses
+
+    def _ship(self, logs: Dict[str, List[str]], statuses: Dict[str, Status]) -> None:
+        """Sends one batch per job that has anything queued"""
+        for job_id in set(logs) | set(statuses):
+            self._send(job_id, logs.get(job_id, []), statuses.get(job_id))
+
+    def _run(self) -> None:
+        """Flushes on a timer, or early whenever a job's batch fills up"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(self._full, timeout=self._max_delay)
+            self.flush()
 
 
 class MgmtApiHelper:
@@ -18,32 +90,51 @@ class MgmtApiHelper:
     def __init__(self):
         self._mgmt_timeout = 5
         self._mgmt_host = env["MGMT_HOST"]
-        self._mgmt_key = env["MGMT_KEY"]
         self._fernet = Fernet(env["SECRET"])
+        self._sink: Union[LogSink, None] = None
+        if env.get("CTM_LOG_BATCHING", "1") == "1":
+            self._start_sink()
+
+    def _start_sink(self) -> None:
+        """Starts buffering logs and status updates through a LogSink"""
+        self._sink = LogSink(
+            self._send_batch,
+            int(env.get("CTM_LOG_BATCH_SIZE", "50")),
+            float(env.get("CTM_LOG_FLUSH_SECS", "2")),
+        )
 
     # region NON JOB-SPECIFIC METHODS
 
-    def get_next_job(self) -> Union[Job, None]:
-        """Gets the next job to do, if any"""
+    def get_next_job(self, wait: int = 0) -> Union[Job, None]:
+        """
+        Claims the next job to do, if any
+        Args: wait (int): seconds the API may hold the request open waiting for a job
+        Returns: (Union[Job, None]): the claimed job, None if there was nothing to do
+        """
         try:
-            resp = requests.get(
-                f"{self._mgmt_host}/api/v1/mgmt/dequeue?mgmtKey={self._mgmt_key}",
-                timeout=self._mgmt_timeout,
+            resp = mgmt_session().get(
+                f"{self._mgmt_host}/api/v1/mgmt/dequeue",
+                params={"wait": wait} if wait else None,
+                timeout=self._mgmt_timeout + wait,
             )
             # 404 response is for if there's nothing to dequeue
             if resp.status_code == 404:
                 return None
             return self._dict_to_job(resp.json())
-        except requests.exceptions.ConnectionError as exc:
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout,
+        ) as exc:
             print("Failed to get next job:")
             print(exc)
+            sleep(self._mgmt_timeout)  # Don't spin on an unreachable API
             return None
 
     def get_resumable_jobs(self) -> List[Job]:
         """Gets all active jobs - only used for resuming between restarts"""
         try:
-            resp = requests.get(
-                f"{self._mgmt_host}/api/v1/mgmt/resumable?mgmtKey={self._mgmt_key}",
+            resp = mgmt_session().get(
+                f"{self._mgmt_host}/api/v1/mgmt/resumable",
                 timeout=self._mgmt_timeout,
             )
             return [self._dict_to_job(x) for x in resp.json()]
@@ -55,42 +146,79 @@ class MgmtApiHelper:
     def _dict_to_job(self, data: Dict) -> Job:
         """Converts a dictionary (from mongo) into a Job"""
         return Job(
-            oauth_token=self._fernet.decrypt(data["oauthToken"]),
+            oauth_token=self._fernet.decrypt(data["oauthToken"]).decode("utf-8"),
             curseforge_slug=data["curseforgeSlug"],
             modrinth_id=data["modrinthId"],
             logs=data["logs"] if "logs" in data else [],
             job_id=data["jobId"],
             status=data["status"],
             queue_place=data["queuePlace"],
+            enqueued_at=data.get("enqueuedAt", ""),
+            profile=data.get("profile", False),
         )
 
     # endregion NON JOB-SPECIFIC METHODS
 
     def update_job_status(self, job_id: str, status: Status) -> None:
         """Updates the status of a job"""
+        if self._sink:
+            self._sink.status(job_id, status)
+            return
+
         try:
-            requests.patch(
-                f"{self._mgmt_host}/api/v1/mgmt/update/{job_id}?mgmtKey={self._mgmt_key}",
-                timeout=self._mgmt_timeout,
-                data={"status": status.value},
-            )
+            with stage("mgmt_patch"):
+                mgmt_session().patch(
+                    f"{self._mgmt_host}/api/v1/mgmt/update/{job_id}",
+                    timeout=self._mgmt_timeout,
+                    data={"status": status.value},
+                )
         except requests.exceptions.ConnectionError as exc:
             print(f"Failed to update the status of job {job_id}:")
             print(exc)
 
     def append_job_log(self, job_id: str, newlog: str) -> None:
         """Appends to the logs for a job"""
+        if self._sink:
+            self._sink.log(job_id, newlog)
+            return
+
         try:
-            requests.patch(
-                f"{self._mgmt_host}/api/v1/mgmt/update/{job_id}?mgmtKey={self._mgmt_key}",
-                timeout=self._mgmt_timeout,
-                data={"log": newlog},
-            )
+            with stage("mgmt_patch"):
+                mgmt_session().patch(
+                    f"{self._mgmt_host}/api/v1/mgmt/update/{job_id}",
+                    timeout=self._mgmt_timeout,
+                    data={"log": newlog},
+                )
         except requests.exceptions.ReadTimeout as exc:
             print(f"Timed out updating the status of job {job_id}:\n{exc}")
         except requests.exceptions.ConnectionError as exc:
             print(f"Failed to update the status of job {job_id}:\n{exc}")
 
+    def flush(self) -> None:
+        """Ships any buffered logs and status updates immediately"""
+        if self._sink:
+            self._sink.flush()
+
+    def _send_batch(
+        self, job_id: str, logs: List[str], status: Union[Status, None]
+    ) -> None:
+        """Sends a batch of logs (oldest first) and/or a new status for a job"""
+        body: Dict = {"logs": logs}
+        if status is not None:
+            body["status"] = status.value
+
+        try:
+            with stage("mgmt_patch"):
+                mgmt_session().patch(
+                    f"{self._mgmt_host}/api/v1/mgmt/update/{job_id}/batch",
+                    timeout=self._mgmt_timeout,
+                    json=body,
+                )
+        except requests.exceptions.ReadTimeout as exc:
+            print(f"Timed out updating job {job_id} with {len(logs)} logs:\n{exc}")
+        except requests.exceptions.ConnectionError as exc:
+            print(f"Failed to update job {job_id} with {len(logs)} logs:\n{exc}")
+
 
 class MgmtApiLogger:
     """
@@ -0,0 +1,80 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: Read-only lookups against the target Modrinth project
+"""
+
+from typing import Callable, Dict, Set
+
+import requests
+
+from common import ModFile
+from http_client import MODRINTH_API, modrinth_session
+
+
+def get_file_hashes(
+    project_id: str, token: str, logmsg: Callable[[str], None]
+) -> Set[str]:
+    """
+    Gets the sha1 of every file already uploaded to a Modrinth project
+    Args:
+        project_id (str): the Modrinth project id or slug
+        token (str): the job's Modrinth token, so unlisted versions are included
+        logmsg (Callable[[str], None]): where to log failures to
+    Returns: (Set[str]): the sha1 hashes, empty if they could not be fetched
+    """
+    try:
+        response = modrinth_session().get(
+            f"{MODRINTH_API}/v2/project/{project_id}/version",
+            timeout=30,
+            headers={"Authorization": token},
+        )
+        if response.status_code != 200:
+            logmsg("🔥 Failed to list existing Modrinth versions, uploading every file")
+            return set()
+        versions = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        logmsg("🕜 Timed out listing existing Modrinth versions, uploading every file")
+        return set()
+
+    return {
+        file["hashes"]["sha1"]
+        for version in versions
+        for file in version["files"]
+        if "sha1" in file["hashes"]
+    }
+
+
+class DeltaFilter:
+    """
+    Picks out the CurseForge files whose jar is not on the Modrinth project yet,
+        keeping count of the ones that are
+    Args: existing (Set[str]): the sha1 of every file already on the project
+    """
+
+    def __init__(self, existing: Set[str]):
+        self._existing = existing
+        self.skipped = 0
+
+    def is_new(self, mod: ModFile) -> bool:
+        """
+        Args: mod (ModFile): a single file from Curse's /files
+        Returns: (bool): False if the same jar is already on Modrinth
+        """
+        if mod.sha1 in self._existing:
+            self.skipped += 1
+            return False
+        return True
+
+
+def upload_matches(version: Dict, sha512: str) -> bool:
+    """
+    Checks that Modrinth stored exactly the jar that was sent
+    Args:
+        version (Dict): the version Modrinth returned from /v2/version
+        sha512 (str): the sha512 of the jar as it was sent
+    Returns: (bool): True if one of the version's files has the same sha512
+    """
+    return any(
+        file["hashes"].get("sha512") == sha512 for file in version.get("files", [])
+    )
@@ -0,0 +1,241 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: Opt-in per-job profiling - a cProfile dump, the top tracemalloc
+    allocations and wall-clock timings of each provider phase, written to a report
+    directory per job
+"""
+
+import cProfile
+import io
+import json
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from os import environ as env
+from os import makedirs, path
+from threading import Lock, local
+from time import monotonic
+from typing import Callable, Dict, Iterator, List, Union
+
+from common import Job
+
+TOP_ALLOCATIONS = 25
+TOP_FUNCTIONS = 50
+
+_tracing_lock = Lock()
+_tracing_jobs = 0
+
+
+class JobProfile:
+    """
+    Everything captured while a single job runs. cProfile only sees the thread it is
+        enabled on, so work handed to a thread pool is profiled through `traced`
+        and merged into the job's profile at the end.
+    Args: job_id (str): the job being profiled
+    """
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.phases: Dict[str, float] = {}
+        self._lock = Lock()
+        self._main: Union[cProfile.Profile, None] = cProfile.Profile()
+        self._workers: List[cProfile.Profile] = []
+        self._local = local()
+        self._started = 0.0
+        self.wall = 0.0
+
+    def start(self) -> None:
+        """Starts profiling the calling thread, which should be the job's own"""
+        self._started = monotonic()
+        try:
+            self._main.enable()
+        except ValueError:  # Another job's profile already owns this thread
+            self._main = None
+
+    def stop(self) -> None:
+        """Stops profiling the job's thread"""
+        if self._main:
+            self._main.disable()
+        self.wall = monotonic() - self._started
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        """
+        Adds wall-clock time to one of the provider's phases
+        Args:
+            name (str): the phase
+            seconds (float): how long it took this time
+        """
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def worker_profile(self) -> cProfile.Profile:
+        """Returns: (Profile): the calling worker thread's profiler, made on first use"""
+        if not hasattr(self._local, "profile"):
+            self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._workers.append(self._local.profile)
+        return self._local.profile
+
+    def stats(self) -> pstats.Stats:
+        """Returns: (Stats): the job thread's profile merged with every worker's"""
+        profiles = [x for x in [self._main, *self._workers] if x]
+        return pstats.Stats(*profiles, stream=io.StringIO())
+
+
+_current: ContextVar[Union[JobProfile, None]] = ContextVar("ctm_profile", default=None)
+
+
+def is_enabled(job: Job) -> bool:
+    """
+    Args: job (Job): the job about to run
+    Returns: (bool): True if CTM_PROFILE=1 or the job asked to be profiled
+    """
+    return env.get("CTM_PROFILE", "0") == "1" or job.profile
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Times one phase of a provider for the current job's profile, if it has one
+    Args: name (str): the phase, e.g. enumerate or upload
+    """
+    profile = _current.get()
+    if not profile:
+        yield
+        return
+
+    started = monotonic()
+    try:
+        yield
+    finally:
+        profile.add_phase(name, monotonic() - started)
+
+
+def traced(func: Callable) -> Callable:
+    """
+    Wraps work that is about to be handed to a thread pool so it is profiled along
+        with the job that submitted it. Must be called from the job's own thread.
+    Args: func (Callable): the work
+    Returns: (Callable): `func` itself if the job is not being profiled
+    """
+    profile = _current.get()
+    if not profile:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        worker = profile.worker_profile()
+        worker.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            worker.disable()
+
+    return wrapper
+
+
+def _start_tracing() -> None:
+    """Starts tracemalloc for the first of any concurrently profiled jobs"""
+    global _tracing_jobs  # pylint: disable=global-statement
+    with _tracing_lock:
+        if not _tracing_jobs and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing_jobs += 1
+
+
+def _stop_tracing() -> None:
+    """Stops tracemalloc once the last concurrently profiled job is done"""
+    global _tracing_jobs  # pylint: disable=global-statement
+    with _tracing_lock:
+        _tracing_jobs -= 1
+        if not _tracing_jobs:
+            tracemalloc.stop()
+
+
+def _write_report(
+    profile: JobProfile, snapshot: tracemalloc.Snapshot, peak: int
+) -> str:
+    """
+    Writes a job's profile to CTM_PROFILE_DIR/<job_id>/
+    Args:
+        profile (JobProfile): the finished profile
+        snapshot (Snapshot): tracemalloc's snapshot from the end of the job
+        peak (int): the most bytes tracemalloc saw allocated at once
+    Returns: (str): the report directory
+    """
+    out_dir = path.join(env.get("CTM_PROFILE_DIR", "./profiles"), profile.job_id)
+    makedirs(out_dir, exist_ok=True)
+
+    stats = profile.stats()
+    stats.dump_stats(path.join(out_dir, "profile.pstats"))
+    with open(path.join(out_dir, "profile.txt"), "w", encoding="utf-8") as out:
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+
+    with open(path.join(out_dir, "allocations.txt"), "w", encoding="utf-8") as out:
+        for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            out.write(f"{stat}\n")
+
+    with open(path.join(out_dir, "summary.json"), "w", encoding="utf-8") as out:
+        json.dump(
+            {
+                "job_id": profile.job_id,
+                "wall_seconds": round(profile.wall, 3),
+                "peak_traced_bytes": peak,
+                "phases": {k: round(v, 3) for k, v in profile.phases.items()},
+            },
+            out,
+            indent=2,
+        )
+    return out_dir
+
+
+def summarize(profile: JobProfile, peak: int) -> str:
+    """
+    Args:
+        profile (JobProfile): the finished profile
+        peak (int): the most bytes tracemalloc saw allocated at once
+    Returns: (str): a one-line summary fit for the job log
+    """
+    slowest = max(profile.phases.items(), key=lambda x: x[1], default=None)
+    line = f"ℹ️ Profiled: {profile.wall:.1f}s wall, peak {peak / 1024 / 1024:.1f} MiB"
+    if slowest:
+        line += f", slowest phase {slowest[0]} ({slowest[1]:.1f}s)"
+    return line
+
+
+@contextmanager
+def profile_job(job: Job, logmsg: Callable[[str], None]) -> Iterator[None]:
+    """
+    Profiles everything run inside the block as the given job, if profiling is on
+        for it. With the async engine the event loop is shared, so the profile also
+        covers whatever other jobs ran alongside it.
+    Args:
+        job (Job): the job about to run
+        logmsg (Callable[[str], None]): where the one-line summary goes, if
+            CTM_PROFILE_SUMMARY=1
+    """
+    if not is_enabled(job):
+        yield
+        return
+
+    profile = JobProfile(job.job_id)
+    token = _current.set(profile)
+    _start_tracing()
+    profile.start()
+    try:
+        yield
+    finally:
+        profile.stop()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        _stop_tracing()
+        _current.reset(token)
+
+        out_dir = _write_report(profile, snapshot, peak)
+        print(f"Profile for job {job.job_id} written to {out_dir}")
+        if env.get("CTM_PROFILE_SUMMARY", "0") == "1":
+            logmsg(summarize(profile, peak))
@@ -0,0 +1,170 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: Per-host token buckets which slow down as soon as a host pushes back
+"""
+
+from email.utils import parsedate_to_datetime
+from os import environ as env
+from random import uniform
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, Mapping, Union
+from urllib.parse import urlparse
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """
+    Exponential backoff with jitter, so retries from many workers do not line up
+    Args:
+        attempt (int): how many tries have failed so far
+        base (float): the delay after the first failure, in seconds
+        cap (float): the longest delay, in seconds
+    Returns: (float): seconds to wait before the next try
+    """
+    return min(cap, base * 2 ** max(0, attempt - 1)) * uniform(0.5, 1.0)
+
+
+def retry_after(headers: Mapping[str, str]) -> Union[float, None]:
+    """
+    Reads a Retry-After header, which is either seconds or an HTTP date
+    Args: headers (Mapping[str, str]): the response headers
+    Returns: (Union[float, None]): seconds to wait, None if there was no usable header
+    """
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """
+    A token bucket for a single host. A host with no configured rate goes
+        uncapped until it first pushes back. On every 429 the rate is cut in half,
+        and it recovers slowly while the host is happy. When the host sends
+        X-Ratelimit-Remaining / X-Ratelimit-Reset, the requests left are spread
+        evenly over the rest of the window instead.
+    Args:
+        rate (Union[float, None]): the most requests per second to ever send, None
+            to start uncapped
+        burst (int): how many requests may go out back to back
+    """
+
+    def __init__(self, rate: Union[float, None], burst: int):
+        self._lock = Lock()
+        self._max_rate = rate or float("inf")
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._stamp = monotonic()
+        self._blocked_until = 0.0
+        self._strikes = 0
+        # How fast requests went out while uncapped, so a 429 can cap it there
+        self._window_start = self._stamp
+        self._window_count = 0
+        self._last_rate = 0.0
+
+    def _sent_rate(self) -> float:
+        """Returns: (float): requests per second sent lately, must hold `_lock`"""
+        return max(1.0, self._last_rate, float(self._window_count))
+
+    def reserve(self) -> float:
+        """
+        Takes a token for a request which is about to be sent
+        Returns: (float): seconds the caller must wait before sending it
+        """
+        with self._lock:
+            now = monotonic()
+            blocked = max(0.0, self._blocked_until - now)
+            if self._rate is None:
+                if now - self._window_start >= 1.0:
+                    self._last_rate = self._window_count / (now - self._window_start)
+                    self._window_start, self._window_count = now, 0
+                self._window_count += 1
+                self._stamp = now
+                return blocked
+
+            self._tokens = min(
+                self._burst, self._tokens + (now - self._stamp) * self._rate
+            )
+            self._stamp = now
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+            # Requests held back by a block are still spaced out once it lifts
+            return blocked + wait
+
+    def observe(self, status: int, headers: Mapping[str, str]) -> None:
+        """
+        Adapts the bucket to a response from the host
+        Args:
+            status (int): the response's status code
+            headers (Mapping[str, str]): the response's headers
+        """
+        with self._lock:
+            now = monotonic()
+            if status == 429:
+                self._strikes += 1
+                delay = retry_after(headers)
+                if delay is None:
+                    delay = backoff_delay(self._strikes)
+                self._blocked_until = max(self._blocked_until, now + delay)
+                if self._rate is None:  # First push back, cap it where it gave out
+                    self._rate = self._max_rate = self._sent_rate()
+                self._rate = max(self._max_rate / 16, self._rate / 2)
+                self._tokens = 0.0
+                return
+
+            self._strikes = 0
+            try:
+                remaining = int(headers["X-Ratelimit-Remaining"])
+                reset = float(headers["X-Ratelimit-Reset"])
+            except (KeyError, ValueError):
+                if self._rate is not None:
+                    self._rate = min(self._max_rate, self._rate * 1.1)
+                return
+
+            if remaining <= 0:  # The window is spent, wait for the next one
+                self._blocked_until = max(self._blocked_until, now + reset)
+                self._tokens = 0.0
+                return
+            self._rate = min(self._max_rate, remaining / max(reset, 1.0))
+
+
+_limiters: Dict[str, HostLimiter] = {}
+_lock = Lock()
+
+
+def configured_rate(host: str) -> Union[float, None]:
+    """
+    Args: host (str): the host, e.g. api.modrinth.com
+    Returns: (Union[float, None]): the host's rate from CTM_RATE_LIMITS (a comma
+        separated list of host=rate), else CTM_RATE_LIMIT, else None for uncapped
+    """
+    for entry in env.get("CTM_RATE_LIMITS", "").split(","):
+        name, _, rate = entry.strip().partition("=")
+        if name == host and rate:
+            return float(rate)
+    default = env.get("CTM_RATE_LIMIT")
+    return float(default) if default else None
+
+
+def limiter_for(url: str) -> HostLimiter:
+    """
+    Gets the limiter for the host `url` points at, creating it on first use
+    Args: url (str): any url on the host in question
+    Returns: (HostLimiter): the limiter shared by every request to that host
+    """
+    host = urlparse(url).netloc
+    with _lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(
+                configured_rate(host), int(env.get("CTM_RATE_BURST", "20"))
+            )
+        return _limiters[host]
@@ -0,0 +1,132 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: A process-wide pool of file workers shared fairly between jobs
+"""
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from os import environ as env
+from threading import Condition, Lock, Thread
+from typing import Callable, Deque, Dict, Iterable, Iterator, Tuple, Union
+
+Unit = Tuple[Future, Callable, tuple]
+
+
+class FairScheduler:
+    """
+    Runs file-level work units from every job on one set of workers. Jobs take
+        turns round-robin, so a job with thousands of files queued cannot hold up
+        one with a handful. Each job also has at most `per_job` units running.
+    Args:
+        workers (int): how many units may run at once across all jobs
+        per_job (int): how many units of a single job may run at once
+    """
+
+    def __init__(self, workers: int, per_job: int):
+        self._workers = workers
+        self._per_job = per_job
+        self._cond = Condition()
+        self._queues: "OrderedDict[str, Deque[Unit]]" = OrderedDict()
+        self._running: Dict[str, int] = {}
+        self._started = False
+
+    def _start(self) -> None:
+        """Starts the workers on first use, must hold `_cond`"""
+        if self._started:
+            return
+        self._started = True
+        for idx in range(self._workers):
+            Thread(target=self._work, name=f"file-worker-{idx}", daemon=True).start()
+
+    def submit(self, job_id: str, func: Callable, *args) -> Future:
+        """
+        Queues a unit of work for a job
+        Args:
+            job_id (str): the job the unit belongs to
+            func (Callable): the work, called with `args`
+        Returns: (Future): the unit's result
+        """
+        future: Future = Future()
+        with self._cond:
+            self._start()
+            self._queues.setdefault(job_id, deque()).append((future, func, args))
+            self._cond.notify()
+        return future
+
+    def map(self, job_id: str, func: Callable, items: Iterable) -> Iterator:
+        """
+        Like Executor.map - queues `func(item)` for every item as it arrives, then
+            yields the results in order. Units still queued when the caller stops
+            iterating are cancelled.
+        Args:
+            job_id (str): the job the units belong to
+            func (Callable): the work, called once per item
+            items (Iterable): the items
+        Returns: (Iterator): each result, in the same order as `items`
+        """
+        futures = [self.submit(job_id, func, item) for item in items]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _next(self) -> Union[Tuple[str, Unit], None]:
+        """
+        Takes the next job's turn, must hold `_cond`
+        Returns: (Union[Tuple[str, Unit], None]): the job and its next unit, None if
+            every job is either idle or at its limit
+        """
+        for job_id, queue in self._queues.items():
+            if self._running.get(job_id, 0) >= self._per_job:
+                continue
+            unit = queue.popleft()
+            if queue:
+                self._queues.move_to_end(job_id)  # Back of the line for its next turn
+            else:
+                del self._queues[job_id]
+            return job_id, unit
+        return None
+
+    def _work(self) -> None:
+        """A worker, which runs units from whichever job's turn it is"""
+        while True:
+            with self._cond:
+                while not (picked := self._next()):
+                    self._cond.wait()
+                job_id, (future, func, args) = picked
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._running[job_id] = self._running.get(job_id, 0) + 1
+
+            try:
+                future.set_result(func(*args))
+            except Exception as exc:  # pylint: disable=broad-except
+                future.set_exception(exc)
+            finally:
+                with self._cond:
+                    self._running[job_id] -= 1
+                    if not self._running[job_id]:
+                        del self._running[job_id]
+                    self._cond.notify_all()
+
+
+_scheduler: Union[FairScheduler, None] = None
+_scheduler_lock = Lock()
+
+
+def get_scheduler() -> FairScheduler:
+    """
+    Returns: (FairScheduler): the process-wide scheduler, with CTM_FILE_WORKERS
+        workers and at most CTM_FILE_CONCURRENCY units per job
+    """
+    global _scheduler  # pylint: disable=global-statement
+    with _scheduler_lock:
+        if not _scheduler:
+            _scheduler = FairScheduler(
+                max(1, int(env.get("CTM_FILE_WORKERS", "8"))),
+                max(1, int(env.get("CTM_FILE_CONCURRENCY", "4"))),
+            )
+        return _scheduler
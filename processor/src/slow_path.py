@@ -0,0 +1,48 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: Lazy entrypoints into the slow path, so Selenium, webdriver_manager and
+    trio are only imported once a job actually needs a browser
+"""
+
+import sys
+
+from common import Job
+from curse_api import CurseClient
+from mgmt_tools import MgmtApiHelper
+
+# pylint: disable=import-outside-toplevel
+
+
+def slow_provider(helper: MgmtApiHelper, job: Job, curse: CurseClient):
+    """
+    Args:
+        helper (MgmtApiHelper): the job database
+        job (Job): the job to process
+        curse (CurseClient): the job's CurseForge client
+    Returns: (SlowProvider): a slow provider for the job
+    """
+    from x_slow_provider import SlowProvider
+
+    return SlowProvider(helper, job, curse)
+
+
+def prewarm(count: int) -> None:
+    """
+    Starts browsers ahead of the first slow job, loading the slow path to do so
+    Args: count (int): how many browsers to start, 0 to leave the slow path unloaded
+    """
+    if count <= 0:
+        return
+    from browser_pool import get_pool
+
+    get_pool().prewarm(count)
+
+
+def shutdown() -> None:
+    """Quits the browsers and the virtual display, if the slow path was ever loaded"""
+    if "browser_pool" not in sys.modules:
+        return
+    from browser_pool import get_pool
+
+    get_pool().shutdown()
@@ -0,0 +1,209 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: Streaming multipart bodies so jars never need to be fully held in memory
+"""
+
+import asyncio
+import hashlib
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Iterable, Iterator, Union
+from uuid import uuid4
+
+from metrics import BYTES
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StreamLengthError(IOError):
+    """Raised when a streamed jar does not match the size it advertised"""
+
+
+class ChecksumError(IOError):
+    """Raised when a streamed jar does not hash to the sha1 Curse advertised"""
+
+
+def checksum_failed(exc: BaseException) -> bool:
+    """
+    HTTP clients re-raise errors from the body they are sending as their own
+        connection errors, so this looks for a ChecksumError anywhere in the chain
+    Args: exc (BaseException): an error raised while sending a jar
+    Returns: (bool): True if the jar did not match its sha1
+    """
+    pending, seen = [exc], set()
+    while pending:
+        err = pending.pop()
+        if err is None or id(err) in seen:
+            continue
+        seen.add(id(err))
+        if isinstance(err, ChecksumError):
+            return True
+        pending.extend([err.__cause__, err.__context__])
+        pending.extend(x for x in err.args if isinstance(x, BaseException))
+    return False
+
+
+def iter_file(jar: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Lazily reads an open file in fixed-size chunks
+    Args:
+        jar (BinaryIO): the open file to read from
+        chunk_size (int): the size of each chunk in bytes
+    Returns: (Iterator[bytes]): the file's contents, one chunk at a time
+    """
+    while chunk := jar.read(chunk_size):
+        yield chunk
+
+
+class MultipartStream:
+    """
+    A multipart/form-data body for Modrinth's /v2/version endpoint which pulls the jar
+        through chunk by chunk instead of buffering it. Passed to `requests` as `data=`,
+        it is sent with a Content-Length if the jar size is known, chunked otherwise.
+    Args:
+        payload (str): the JSON `data` part for the version
+        file_name (str): the name of the jar being uploaded
+        chunks (Union[Iterable[bytes], AsyncIterable[bytes]]): the jar contents, async
+            iterables are for aiohttp which consumes the body with `async for`
+        file_size (int): the size of the jar in bytes, 0 if unknown
+    """
+
+    def __init__(
+        self,
+        payload: str,
+        file_name: str,
+        chunks: Union[Iterable[bytes], AsyncIterable[bytes]],
+        file_size: int,
+    ):
+        self._boundary = uuid4().hex
+        self._chunks = chunks
+        self._file_size = file_size
+        self._head = (
+            f"--{self._boundary}\r\n"
+            'Content-Disposition: form-data; name="data"\r\n\r\n'
+            f"{payload}\r\n"
+            f"--{self._boundary}\r\n"
+            f'Content-Disposition: form-data; name="files"; filename="{file_name}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        self._tail = f"\r\n--{self._boundary}--\r\n".encode("utf-8")
+
+    @property
+    def content_type(self) -> str:
+        """Returns: (str): the Content-Type header value for this body"""
+        return f"multipart/form-data; boundary={self._boundary}"
+
+    def __len__(self) -> int:
+        if not self._file_size:
+            return 0
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self._head
+        sent = 0
+        for chunk in self._chunks:
+            sent += len(chunk)
+            yield chunk
+        BYTES.labels("uploaded").inc(sent)
+        if self._file_size and sent != self._file_size:
+            raise StreamLengthError(
+                f"Expected {self._file_size} bytes but the jar had {sent}"
+            )
+        yield self._tail
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield self._head
+        sent = 0
+        async for chunk in self._chunks:
+            sent += len(chunk)
+            yield chunk
+        BYTES.labels("uploaded").inc(sent)
+        if self._file_size and sent != self._file_size:
+            raise StreamLengthError(
+                f"Expected {self._file_size} bytes but the jar had {sent}"
+            )
+        yield self._tail
+
+
+class HashedChunks:
+    """
+    Passes a jar's chunks through while hashing them, so the jar is verified in the
+        same pass that downloads or uploads it. The check runs before the last chunk
+        is handed on, so a bad jar never reaches the end of an upload.
+    Args:
+        chunks (Union[Iterable[bytes], AsyncIterable[bytes]]): the jar contents
+        sha1 (Union[str, None]): the expected sha1, None to only hash
+    """
+
+    def __init__(
+        self,
+        chunks: Union[Iterable[bytes], AsyncIterable[bytes]],
+        sha1: Union[str, None],
+    ):
+        self._chunks = chunks
+        self._expected = sha1
+        self._sha1 = hashlib.sha1()
+        self._sha512 = hashlib.sha512()
+        self.verified = False
+
+    @property
+    def sha512(self) -> str:
+        """Returns: (str): the hex sha512 of everything passed through so far"""
+        return self._sha512.hexdigest()
+
+    def _update(self, chunk: bytes) -> None:
+        self._sha1.update(chunk)
+        self._sha512.update(chunk)
+
+    def _verify(self) -> None:
+        if self._expected and self._sha1.hexdigest() != self._expected.lower():
+            raise ChecksumError(
+                f"Expected sha1 {self._expected} but the jar had {self._sha1.hexdigest()}"
+            )
+        self.verified = True
+
+    def __iter__(self) -> Iterator[bytes]:
+        held = None
+        for chunk in self._chunks:
+            self._update(chunk)
+            if held is not None:
+                yield held
+            held = chunk
+        self._verify()
+        if held is not None:
+            yield held
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        held = None
+        async for chunk in self._chunks:
+            self._update(chunk)
+            if held is not None:
+                yield held
+            held = chunk
+        self._verify()
+        if held is not None:
+            yield held
+
+
+class TeeChunks:
+    """
+    Passes a jar's chunks through while copying them into a file
+    Args:
+        chunks (Union[Iterable[bytes], AsyncIterable[bytes]]): the jar contents
+        sink (BinaryIO): where the copy goes
+    """
+
+    def __init__(
+        self, chunks: Union[Iterable[bytes], AsyncIterable[bytes]], sink: BinaryIO
+    ):
+        self._chunks = chunks
+        self._sink = sink
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._chunks:
+            self._sink.write(chunk)
+            yield chunk
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._chunks:
+            await asyncio.to_thread(self._sink.write, chunk)
+            yield chunk
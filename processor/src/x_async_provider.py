@@ -0,0 +1,321 @@
+"""
+@author: oitsjustjose @ github / twitter / modrinth
+@license: MIT
+@description: An asyncio take on the FastProvider, which streams every jar straight
+    from Curse into Modrinth so thousands of transfers can share one process
+"""
+
+import asyncio
+import json
+from contextlib import nullcontext
+from functools import partial
+from os import fstat
+from textwrap import dedent
+from typing import AsyncIterator, BinaryIO, List, Set, Tuple, Union
+
+import aiohttp
+
+import metrics
+import profiling
+from async_curse_api import AsyncCurseClient
+from async_http_client import get_session, host_limit
+from async_scheduler import get_scheduler
+from common import Job, ModFile, Status
+from http_client import MODRINTH_API
+from jar_store import get_store
+from journal import JobJournal
+from mgmt_tools import MgmtApiHelper, MgmtApiLogger
+from modrinth_api import DeltaFilter, get_file_hashes, upload_matches
+from rate_limit import backoff_delay
+from streaming import (
+    CHUNK_SIZE,
+    ChecksumError,
+    HashedChunks,
+    MultipartStream,
+    StreamLengthError,
+    checksum_failed,
+)
+
+
+async def read_blob(blob: BinaryIO) -> AsyncIterator[bytes]:
+    """
+    Reads an open jar in fixed-size chunks without blocking the event loop
+    Args: blob (BinaryIO): the open jar
+    Returns: (AsyncIterator[bytes]): the jar's contents, one chunk at a time
+    """
+    while chunk := await asyncio.to_thread(blob.read, CHUNK_SIZE):
+        yield chunk
+
+
+class AsyncFastProvider(MgmtApiLogger):
+    """
+    The asyncio class for handling curse downloads
+    Args:
+        helper (MgmtApiHelper): the job database
+        job (Job): the job to process
+        curse (AsyncCurseClient): the job's async CurseForge client
+    """
+
+    def __init__(self, helper: MgmtApiHelper, job: Job, curse: AsyncCurseClient):
+        super().__init__(helper, job.job_id)
+        self._helper = helper
+        self._job = job
+        self._curse = curse
+        self._rel_map = {1: "release", 2: "beta", 3: "alpha"}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def cancel(self) -> None:
+        """Cancels every in-flight transfer for this job"""
+        for task in self._tasks:
+            task.cancel()
+
+    async def _post_version(self, body: MultipartStream) -> aiohttp.ClientResponse:
+        """
+        Posts a new version to Modrinth
+        Args: body (MultipartStream): the version payload and jar
+        Returns: (ClientResponse): Modrinth's (already read) response
+        """
+        headers = {
+            "Authorization": self._job.oauth_token,
+            "Content-Type": body.content_type,
+        }
+        if len(body):
+            headers["Content-Length"] = str(len(body))
+
+        async with host_limit(MODRINTH_API), get_session().post(
+            f"{MODRINTH_API}/v2/version", headers=headers, data=body
+        ) as response:
+            await response.read()
+            return response
+
+    async def _upload(
+        self, mod: ModFile, payload: str
+    ) -> Tuple[aiohttp.ClientResponse, str]:
+        """
+        Streams a jar into a new Modrinth version, from the jar store if it has it
+            and straight from Curse otherwise (copying it into the store as it goes),
+            checking it against Curse's sha1
+        Args:
+            mod (ModFile): a single file from the /files listing
+            payload (str): the JSON `data` part for the version
+        Returns: (Tuple[ClientResponse, str]): Modrinth's (already read) response
+            and the sha512 of the jar that was sent
+        """
+        sha1 = mod.sha1
+        store = get_store()
+        blob = store.open_blob(mod) if store else None
+        if blob:
+            with blob:
+                size = fstat(blob.fileno()).st_size
+                chunks = HashedChunks(read_blob(blob), sha1)
+                response = await self._post_version(
+                    MultipartStream(payload, mod.file_name, chunks, size)
+                )
+                return response, chunks.sha512
+
+        async with host_limit(mod.download_url), get_session().get(
+            mod.download_url
+        ) as strm:
+            strm.raise_for_status()
+            size = mod.file_length or strm.content_length or 0
+            chunks = metrics.downloaded_async(strm.content.iter_chunked(CHUNK_SIZE))
+            # The jar fills the store on its way past, if there is one
+            with (
+                store.tee(mod, chunks)
+                if store and store.accepts(mod)
+                else nullcontext(HashedChunks(chunks, sha1))
+            ) as hashed:
+                response = await self._post_version(
+                    MultipartStream(payload, mod.file_name, hashed, size)
+                )
+                return response, hashed.sha512
+
+    async def _process_mod(self, mod: ModFile) -> Union[Status, None]:
+        """
+        Downloads and then uploads a single mod file from a page of mods from /list
+        Args: mod (ModFile): a single file from the /files listing
+        Returns: (Union[Status, None]): the status for the mod, None if it was skipped
+        """
+        if not mod.is_available or not mod.download_url:
+            return None
+
+        display_nm = mod.display_name
+        async with get_scheduler().slot(self._job.job_id):
+            payload = json.dumps(
+                {
+                    "name": display_nm,
+                    "version_number": mod.version_number,
+                    "changelog": await self._curse.get_changelog(mod.file_id),
+                    "dependencies": [],  # Dependencies need to be manually included
+                    "game_versions": mod.game_versions,
+                    "loaders": mod.loaders,
+                    "featured": False,
+                    "version_type": self._rel_map[mod.release_type],
+                    "requested_status": "listed",
+                    "project_id": self._job.modrinth_id,
+                    "primary_file": mod.file_name,
+                    "file_parts": [mod.file_name],
+                }
+            )
+
+            tries, msg = 1, ""
+            while tries <= 5:
+                try:
+                    with metrics.stage("upload"):
+                        response, sha512 = await self._upload(mod, payload)
+                except asyncio.TimeoutError:
+                    tries += 1
+                    msg = f"🕜 Timed out uploading {mod.file_name}. Manual upload required"
+                    metrics.retried(MODRINTH_API)
+                    await asyncio.sleep(backoff_delay(tries))
+                    continue
+                except (aiohttp.ClientError, StreamLengthError, ChecksumError) as exc:
+                    if checksum_failed(exc):
+                        self.logmsg(
+                            f"🔥 {display_nm} from Curse did not match its checksum, skipping.."
+                        )
+                        return Status.FAIL
+                    tries += 1
+                    msg = f"🔥 Uploading {display_nm} to Modrinth failed, skipping.."
+                    metrics.retried(MODRINTH_API)
+                    await asyncio.sleep(backoff_delay(tries))
+                    continue
+
+                if response.status == 429:
+                    tries += 1
+                    metrics.retried(MODRINTH_API)
+                    msg = f"🕜 Modrinth kept rate limiting {mod.file_name}. Manual upload required"
+                    continue  # The rate limiter already backs off for us
+
+                if response.status == 200:
+                    if not upload_matches(await response.json(), sha512):
+                        self.logmsg(
+                            f"🔥 {display_nm} was changed on the way to Modrinth, please check it manually"
+                        )
+                        return Status.FAIL
+                    self.logmsg(f"✅ {display_nm}")
+                    return Status.SUCCESS
+
+                self.logmsg(
+                    dedent(
+                        f"""----- 🔥 {display_nm} -----
+                        API Response from Modrinth FAIL for {display_nm}:
+                        {await self.decode_modrinth_resp_async(response)}
+                        """
+                    ).strip("\n")
+                )
+                return Status.FAIL
+
+        self.logmsg(msg)
+        return Status.FAIL
+
+    @staticmethod
+    async def decode_modrinth_resp_async(resp: aiohttp.ClientResponse) -> str:
+        """
+        Decodes a modrinth response into a normal, human-readable string
+        Args: resp (ClientResponse): the (already read) response from your request
+        Returns: (str): the human-readable string
+        """
+        try:
+            return (await resp.json(content_type=None))["description"]
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return await resp.text()
+
+    async def process(self) -> Status:
+        """Returns: (status): the status of the procedure"""
+        self.logmsg("ℹ️ Retrieving Curse ModID from Slug")
+        with profiling.phase("slug_lookup"):
+            if not await self._curse.mod_id():
+                return Status.FAIL
+
+        self.logmsg("ℹ️ Enumerating Curse API Pages")
+        with profiling.phase("enumerate"):
+            total = await self._curse.get_file_count()
+        if total == -1:
+            return Status.FAIL
+
+        self.logmsg("ℹ️ Comparing against files already on Modrinth")
+        with profiling.phase("delta"):
+            delta = DeltaFilter(
+                await asyncio.to_thread(
+                    get_file_hashes,
+                    self._job.modrinth_id,
+                    self._job.oauth_token,
+                    self.logmsg,
+                )
+            )
+
+        # Every file gets a task as soon as its page arrives, the scheduler keeps
+        # only CTM_ASYNC_FILE_CONCURRENCY of them transferring at once, taking turns
+        # with other jobs' files. Changelogs are prefetched as the tasks are made.
+        self.logmsg(f"ℹ️ Processing {total} files")
+        ordered: List[asyncio.Task] = []
+        done = 0
+
+        journal = JobJournal(self._job.job_id)
+
+        def on_done(task: asyncio.Task, mod: ModFile) -> None:
+            nonlocal done
+            self._tasks.discard(task)
+            if not task.cancelled() and task.exception() is None and task.result():
+                journal.record(mod.file_id, task.result())
+                metrics.FILES.labels("async", task.result().name).inc()
+            done += 1
+            skipped = delta.skipped + len(journal.replayed)
+            if done % 50 == 0 or done + skipped == total:
+                self.logmsg(f"ℹ️ Processed {done} files")
+
+        try:
+            with profiling.phase("transfer"):
+                async for mod in self._curse.iter_files():
+                    if not journal.is_pending(mod) or not delta.is_new(mod):
+                        continue
+                    self._curse.prefetch_changelog(mod.file_id)
+                    task = asyncio.ensure_future(self._process_mod(mod))
+                    self._tasks.add(task)
+                    task.add_done_callback(partial(on_done, mod=mod))
+                    ordered.append(task)
+                results = await asyncio.gather(*ordered)
+        finally:
+            self.cancel()
+            self._curse.cancel_prefetch()
+            journal.close()
+
+        statuses = [x for x in results if x is not None]
+        if journal.replayed:
+            self.logmsg(
+                f"⏭️ Resumed past {len(journal.replayed)} files finished by an earlier run"
+            )
+            statuses.extend(journal.replayed)
+        if delta.skipped:
+            self.logmsg(f"⏭️ Skipped {delta.skipped} files already on Modrinth")
+            statuses.extend([Status.SUCCESS] * delta.skipped)
+            metrics.FILES.labels("async", "SKIPPED").inc(delta.skipped)
+        any_succ = len(list(filter(lambda x: x == Status.SUCCESS, statuses))) > 0
+        any_fail = len(list(filter(lambda x: x == Status.FAIL, statuses))) > 0
+        status = (
+            Status.PARTIAL_FAIL
+            if any_succ and any_fail
+            else Status.SUCCESS if any_succ and not any_fail else Status.FAIL
+        )
+
+        return status
+
+    async def supports_downloads(self) -> bool:
+        """
+        Determines if the mod even allows for third party launcher downloads
+        Returns (bool): True if it does, False otherwise
+        """
+        try:
+            if not await self._curse.mod_id():
+                return False
+
+            listing = await self._curse.get_files()
+            if listing:
+                return bool(listing["data"][0].download_url)
+            return False
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.logmsg(
+                "🕜 Timed out determining if Mod supports third party downloads"
+            )
+            return False
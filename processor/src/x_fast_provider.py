@@ -6,17 +6,38 @@
 """
 
 import json
+from contextlib import contextmanager, nullcontext
 from os import environ as env
+from os import fstat, makedirs, path
 from os import unlink as rm
+from shutil import rmtree as rmdir
 from textwrap import dedent
-from typing import List
+from time import sleep
+from typing import BinaryIO, Iterator, List, Tuple, Union
 
 import requests
 from urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 import curse_api as cf
-from common import Job, Status
+import metrics
+import profiling
+from common import Job, ModFile, Status
+from http_client import MODRINTH_API, modrinth_session, session_for
+from jar_store import get_store
+from journal import JobJournal
 from mgmt_tools import MgmtApiHelper, MgmtApiLogger
+from modrinth_api import DeltaFilter, get_file_hashes, upload_matches
+from rate_limit import backoff_delay
+from scheduler import get_scheduler
+from streaming import (
+    CHUNK_SIZE,
+    ChecksumError,
+    HashedChunks,
+    MultipartStream,
+    StreamLengthError,
+    checksum_failed,
+    iter_file,
+)
 
 
 class FastProvider(MgmtApiLogger):
@@ -24,155 +45,326 @@ class FastProvider(MgmtApiLogger):
     The class for handling curse downloads
     Args:
         helper (MgmtApiHelper): the job database
-        job_id (str): the job id for the given job
+        job (Job): the job to process
+        curse (CurseClient): the job's CurseForge client
     """
 
-    def __init__(self, helper: MgmtApiHelper, job: Job):
+    def __init__(self, helper: MgmtApiHelper, job: Job, curse: cf.CurseClient):
         super().__init__(helper, job.job_id)
         self._helper = helper
         self._job = job
-        self._modid = cf.get_modid(job.curseforge_slug, self.logmsg)
+        self._curse = curse
         self._rel_map = {1: "release", 2: "beta", 3: "alpha"}
+        self._stream = env.get("CTM_STREAM_UPLOADS", "0") == "1"
+        self._journal: Union[JobJournal, None] = None
+        self._scratch_dir = path.realpath(f"./out/{job.job_id}/")
 
-    def _process_all_mods(self, mods: dict) -> List[Status]:
+    def _scratch_path(self, mod: ModFile) -> str:
         """
-        Downloads and then uploads all mods from a given page of mods from /list
-        Args: mods (dict): the JSON payload from /list
-        Returns: (List[Status]): a list of statuses for each mod
+        Args: mod (ModFile): a single file from the /files listing
+        Returns: (str): where the mod's scratch copy goes, unique to this job and file
         """
-        statuses = []
-        for mod in mods:
-            if (
-                not mod["isAvailable"]
-                or "downloadUrl" not in mod
-                or not mod["downloadUrl"]
-            ):
-                continue
+        return path.join(self._scratch_dir, f"{mod.file_id}-{mod.file_name}")
+
+    def _download(self, mod: ModFile) -> Union[BinaryIO, None]:
+        """
+        Downloads a mod's jar from Curse, checking it against Curse's sha1 - into
+            the jar store if there is one, otherwise into a scratch copy
+        Args: mod (ModFile): a single file from the /files listing
+        Returns: (Union[BinaryIO, None]): the stored blob open for reading, None if
+            the jar went into a scratch copy
+        """
+        with metrics.stage("download"), session_for(mod.download_url).get(
+            mod.download_url, stream=True, timeout=30
+        ) as strm:
+            strm.raise_for_status()
+            chunks = HashedChunks(
+                metrics.downloaded(strm.iter_content(chunk_size=CHUNK_SIZE)), mod.sha1
+            )
+            store = get_store()
+            if store and store.accepts(mod):
+                return store.fill(mod, chunks)
+
+            with open(self._scratch_path(mod), "wb") as jar:
+                for chunk in chunks:
+                    jar.write(chunk)
+            return None
+
+    @contextmanager
+    def _jar_source(
+        self, mod: ModFile, blob: Union[BinaryIO, None]
+    ) -> Iterator[Tuple[HashedChunks, int]]:
+        """
+        Opens the jar for a mod as a stream of chunks - from its blob in the jar
+            store if it has one, straight from Curse when streaming (copying it into
+            the store as it goes), otherwise from the scratch copy. The chunks are
+            checked against Curse's sha1 as they are read.
+        Args:
+            mod (ModFile): a single file from the /files listing
+            blob (Union[BinaryIO, None]): the jar's blob, already open
+        Returns: (Iterator[Tuple[HashedChunks, int]]): the chunks and the jar size
+        """
+        sha1 = mod.sha1
+        if blob:
+            blob.seek(0)
+            yield HashedChunks(iter_file(blob), sha1), fstat(blob.fileno()).st_size
+            return
+
+        store = get_store()
+
+        if self._stream:
+            with session_for(mod.download_url).get(
+                mod.download_url, stream=True, timeout=30
+            ) as strm:
+                strm.raise_for_status()
+                size = mod.file_length or int(strm.headers.get("Content-Length", 0))
+                chunks = metrics.downloaded(strm.iter_content(chunk_size=CHUNK_SIZE))
+                # The jar fills the store on its way past, if there is one
+                with (
+                    store.tee(mod, chunks)
+                    if store and store.accepts(mod)
+                    else nullcontext(HashedChunks(chunks, sha1))
+                ) as hashed:
+                    yield hashed, size
+            return
+
+        with open(self._scratch_path(mod), "rb") as jar:
+            yield HashedChunks(iter_file(jar), sha1), fstat(jar.fileno()).st_size
+
+    def _process_mod(self, mod: ModFile) -> Union[Status, None]:
+        """
+        Downloads and then uploads a single mod file from a page of mods from /list
+        Args: mod (ModFile): a single file from the /files listing
+        Returns: (Union[Status, None]): the status for the mod, None if it was skipped
+        """
+        if not mod.is_available or not mod.download_url:
+            return None
 
-            jar_fn = mod["fileName"]
-            display_nm = mod["displayName"]
+        display_nm = mod.display_name
 
-            game_versions, loaders = cf.get_loader_info(mod["gameVersions"])
-            # region DOWNLOAD JAR FILE
+        # region DOWNLOAD JAR FILE
+        # The blob is held open until the upload is done, so another worker's
+        # commit cannot evict it out from under us
+        store = get_store()
+        blob = store.open_blob(mod) if store else None
+        if not self._stream and not blob:
             try:
-                with requests.get(mod["downloadUrl"], stream=True, timeout=30) as strm:
-                    strm.raise_for_status()
-                    with open(jar_fn, "wb") as jar:
-                        for chunk in strm.iter_content(chunk_size=8192):
-                            jar.write(chunk)
-            except (ProtocolError, requests.exceptions.ChunkedEncodingError):
-                self.logmsg(f"🔥 Downloading {display_nm} from Curse failed, skipping..")
-                statuses.append(Status.FAIL)
-                continue
+                blob = self._download(mod)
+            except (
+                ProtocolError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.HTTPError,
+            ):
+                self.logmsg(
+                    f"🔥 Downloading {display_nm} from Curse failed, skipping.."
+                )
+                return Status.FAIL
+            except ChecksumError:
+                self._cleanup(mod)
+                self.logmsg(
+                    f"🔥 {display_nm} from Curse did not match its checksum, skipping.."
+                )
+                return Status.FAIL
             except TimeoutError:
                 self.logmsg(f"🕜 Timed out downloading {display_nm}, skipping..")
-                statuses.append(Status.FAIL)
-                continue
-            # endregion DOWNLOAD JAR FILE
-
-            # region UPLOAD JAR FILE
-            with open(jar_fn, "rb") as modfile:
-                jar_data = modfile.read()
-
-            payload = json.dumps(
-                {
-                    "name": display_nm,
-                    "version_number": cf.get_version(display_nm),
-                    "changelog": cf.get_changelog(self._modid, mod["id"]),
-                    "dependencies": [],  # Dependencies need to be manually included
-                    "game_versions": game_versions,
-                    "loaders": loaders,
-                    "featured": False,
-                    "version_type": self._rel_map[mod["releaseType"]],
-                    "requested_status": "listed",
-                    "project_id": self._job.modrinth_id,
-                    "primary_file": jar_fn,
-                    "file_parts": [jar_fn],
-                }
-            )
+                return Status.FAIL
+        # endregion DOWNLOAD JAR FILE
+
+        with blob or nullcontext():
+            return self._upload_mod(mod, blob)
+
+    def _upload_mod(self, mod: ModFile, blob: Union[BinaryIO, None]) -> Status:
+        """
+        Uploads a single mod file to Modrinth
+        Args:
+            mod (ModFile): a single file from the /files listing
+            blob (Union[BinaryIO, None]): the jar's blob in the jar store, if open
+        Returns: (Status): the status for the mod
+        """
+        jar_fn = mod.file_name
+        display_nm = mod.display_name
+
+        # region UPLOAD JAR FILE
+        payload = json.dumps(
+            {
+                "name": display_nm,
+                "version_number": mod.version_number,
+                "changelog": self._curse.get_changelog(mod.file_id),
+                "dependencies": [],  # Dependencies need to be manually included
+                "game_versions": mod.game_versions,
+                "loaders": mod.loaders,
+                "featured": False,
+                "version_type": self._rel_map[mod.release_type],
+                "requested_status": "listed",
+                "project_id": self._job.modrinth_id,
+                "primary_file": jar_fn,
+                "file_parts": [jar_fn],
+            }
+        )
 
-            tries, msg = 1, ""
-            while tries <= 5:
-                try:
-                    response = requests.post(
-                        "https://api.modrinth.com/v2/version",
+        tries, msg = 1, ""
+        while tries <= 5:
+            try:
+                with metrics.stage("upload"), self._jar_source(mod, blob) as (
+                    chunks,
+                    size,
+                ):
+                    body = MultipartStream(payload, jar_fn, chunks, size)
+                    response = modrinth_session().post(
+                        f"{MODRINTH_API}/v2/version",
                         timeout=30,
-                        headers={"Authorization": self._job.oauth_token},
-                        files=[
-                            ("data", (None, payload, None)),
-                            ("files", (jar_fn, jar_data, "application/octet-stream")),
-                        ],
+                        headers={
+                            "Authorization": self._job.oauth_token,
+                            "Content-Type": body.content_type,
+                        },
+                        data=body,
                     )
-                    if response.status_code == 200:
-                        statuses.append(Status.SUCCESS)
-                        self.logmsg(f"✅ {display_nm}")
-                    else:
-                        statuses.append(Status.FAIL)
+                if response.status_code == 429:
+                    tries += 1
+                    metrics.retried(MODRINTH_API)
+                    msg = f"🕜 Modrinth kept rate limiting {jar_fn}. Manual upload required"
+                    continue  # The rate limiter already backs off for us
+
+                self._cleanup(mod)
+                if response.status_code == 200:
+                    if not upload_matches(response.json(), chunks.sha512):
                         self.logmsg(
-                            dedent(
-                                f"""----- 🔥 {display_nm} -----
-                                API Response from Modrinth FAIL for {display_nm}:
-                                {self.decode_modrinth_resp(response)}
-                                """
-                            ).strip("\n")
+                            f"🔥 {display_nm} was changed on the way to Modrinth, please check it manually"
                         )
+                        return Status.FAIL
+                    self.logmsg(f"✅ {display_nm}")
+                    return Status.SUCCESS
 
-                    rm(jar_fn)
-                    break
-                except (
-                    requests.exceptions.ReadTimeout,
-                    ReadTimeoutError,
-                    TimeoutError,
-                ):
-                    tries += 1
-                    msg = f"🕜 Timed out uploading {jar_fn}. Manual upload required"
-                    continue
-                except (ProtocolError, requests.exceptions.ChunkedEncodingError):
-                    tries += 1
-                    msg = f"🔥 Uploading {display_nm} to Modrinth failed, skipping.."
-                    continue
-            if tries == 5:
-                self.logmsg(msg)
-                statuses.append(Status.FAIL)
-            # endregion UPLOAD JAR FILE
-        return statuses
+                self.logmsg(
+                    dedent(
+                        f"""----- 🔥 {display_nm} -----
+                        API Response from Modrinth FAIL for {display_nm}:
+                        {self.decode_modrinth_resp(response)}
+                        """
+                    ).strip("\n")
+                )
+                return Status.FAIL
+            except (
+                requests.exceptions.ReadTimeout,
+                ReadTimeoutError,
+                TimeoutError,
+            ):
+                tries += 1
+                msg = f"🕜 Timed out uploading {jar_fn}. Manual upload required"
+                metrics.retried(MODRINTH_API)
+                sleep(backoff_delay(tries))
+                continue
+            except (
+                ProtocolError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.HTTPError,
+                StreamLengthError,
+                ChecksumError,
+            ) as exc:
+                if checksum_failed(exc):
+                    self._cleanup(mod)
+                    self.logmsg(
+                        f"🔥 {display_nm} from Curse did not match its checksum, skipping.."
+                    )
+                    return Status.FAIL
+                tries += 1
+                msg = f"🔥 Uploading {display_nm} to Modrinth failed, skipping.."
+                metrics.retried(MODRINTH_API)
+                sleep(backoff_delay(tries))
+                continue
+
+        self.logmsg(msg)
+        self._cleanup(mod)
+        return Status.FAIL
+        # endregion UPLOAD JAR FILE
+
+    def _checkpointed(self, mod: ModFile) -> Union[Status, None]:
+        """
+        Processes a single mod file and records its outcome in the job's journal
+        Args: mod (ModFile): a single file from the /files listing
+        Returns: (Union[Status, None]): the status for the mod, None if it was skipped
+        """
+        try:
+            status = self._process_mod(mod)
+        except OSError as exc:
+            self._cleanup(mod)
+            self.logmsg(f"🔥 {mod.display_name} failed ({exc}), skipping..")
+            status = Status.FAIL
+        if status is not None:
+            self._journal.record(mod.file_id, status)
+            metrics.FILES.labels("fast", status.name).inc()
+        return status
+
+    def _cleanup(self, mod: ModFile) -> None:
+        """
+        Removes the scratch copy of a jar, if one was made
+        Args: mod (ModFile): a single file from the /files listing
+        """
+        scratch = self._scratch_path(mod)
+        if not self._stream and path.exists(scratch):
+            rm(scratch)
 
     def process(self) -> Status:
         """Returns: (status): the status of the procedure"""
         self.logmsg("ℹ️ Retrieving Curse ModID from Slug")
-        if not self._modid:
-            return Status.FAIL
+        with profiling.phase("slug_lookup"):
+            if not self._curse.mod_id:
+                return Status.FAIL
 
         self.logmsg("ℹ️ Enumerating Curse API Pages")
-        pages, last_size = cf.get_pages(self._modid, self.logmsg)
-        if pages == -1 and last_size == -1:
+        with profiling.phase("enumerate"):
+            total = self._curse.get_file_count()
+        if total == -1:
             return Status.FAIL
 
-        self.logmsg(f"ℹ️ Processing {(pages*50)+last_size} files")
+        self.logmsg("ℹ️ Comparing against files already on Modrinth")
+        with profiling.phase("delta"):
+            delta = DeltaFilter(
+                get_file_hashes(
+                    self._job.modrinth_id, self._job.oauth_token, self.logmsg
+                )
+            )
+
+        # Files are handed to the shared file workers as soon as their page arrives,
+        # taking turns with other jobs' files, and the results come back in listing
+        # order. Each file's changelog is prefetched as it is queued, so uploads
+        # never wait on it.
+        self.logmsg(f"ℹ️ Processing {total} files")
+        self._journal = JobJournal(self._job.job_id)
+        makedirs(self._scratch_dir, exist_ok=True)
         statuses: List[Status] = []
         try:
-            for idx in range(pages):
-                response = requests.get(
-                    f"https://api.curseforge.com/v1/mods/{self._modid}/files?index={idx}",
-                    headers={"x-api-key": env["CURSE_API_KEY"]},
-                    timeout=30,
+            with profiling.phase("transfer"):
+                pending = filter(
+                    lambda x: self._journal.is_pending(x) and delta.is_new(x),
+                    self._curse.iter_files(),
                 )
-                statuses += self._process_all_mods(response.json()["data"])
-                self.logmsg(f"ℹ️ Processed {((idx+1)*50)} files")
-
-            if last_size != 0:  # Handle the last, possibly incomplete page of mods
-                response = requests.get(
-                    f"https://api.curseforge.com/v1/mods/{self._modid}/files?index={pages}&pageSize={last_size}",
-                    headers={"x-api-key": env["CURSE_API_KEY"]},
-                    timeout=30,
+                results = get_scheduler().map(
+                    self._job.job_id,
+                    profiling.traced(self._checkpointed),
+                    self._curse.prefetch_changelogs(pending),
                 )
-                statuses += self._process_all_mods(response.json()["data"])
-                self.logmsg(f"ℹ️ Processed {last_size} files")
-        except TimeoutError:
-            statuses = [Status.FAIL]
+                for idx, result in enumerate(results, start=1):
+                    if result is not None:
+                        statuses.append(result)
+                    done = idx + delta.skipped + len(self._journal.replayed)
+                    if idx % 50 == 0 or done == total:
+                        self.logmsg(f"ℹ️ Processed {idx} files")
+        finally:
+            self._curse.cancel_prefetch()
+            self._journal.close()
+            rmdir(self._scratch_dir, ignore_errors=True)
+
+        if self._journal.replayed:
             self.logmsg(
-                f"🕜 Timed out enumerating files for {self._job.curseforge_slug} ({self._modid})"
+                f"⏭️ Resumed past {len(self._journal.replayed)} files finished by an earlier run"
             )
+            statuses.extend(self._journal.replayed)
+        if delta.skipped:
+            self.logmsg(f"⏭️ Skipped {delta.skipped} files already on Modrinth")
+            statuses.extend([Status.SUCCESS] * delta.skipped)
+            metrics.FILES.labels("fast", "SKIPPED").inc(delta.skipped)
 
         any_succ = len(list(filter(lambda x: x == Status.SUCCESS, statuses))) > 0
         any_fail = len(list(filter(lambda x: x == Status.FAIL, statuses))) > 0
@@ -190,18 +382,12 @@ class FastProvider(MgmtApiLogger):
         Returns (bool): True if it does, False otherwise
         """
         try:
-            modid = cf.get_modid(self._job.curseforge_slug, self.logmsg)
-            if not modid:
+            if not self._curse.mod_id:
                 return False
 
-            response = requests.get(
-                f"https://api.curseforge.com/v1/mods/{modid}/files",
-                headers={"x-api-key": env["CURSE_API_KEY"]},
-                timeout=30,
-            )
-            if response.ok:
-                data = response.json()["data"]
-                return "downloadUrl" in data[0]
+            listing = self._curse.get_files()
+            if listing:
+                return bool(listing["data"][0].download_url)
             return False
         except TimeoutError:
             self.logmsg(
@@ -6,29 +6,44 @@
 """
 
 import json
+from contextlib import nullcontext
+from dataclasses import replace
 from os import environ as env
-from os import makedirs, path
+from os import fstat, makedirs, path
 from os import unlink as rm
 from shutil import rmtree as rmdir
 from textwrap import dedent
 from time import sleep
-from typing import List, Union
+from typing import BinaryIO, Dict, List, Union
 
 import requests
 import selenium.common.exceptions as selex
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from urllib3.exceptions import ProtocolError, ReadTimeoutError
-from webdriver_manager.chrome import ChromeDriverManager
 
 import curse_api as cf
-from common import Job, Status
+import metrics
+import profiling
+from browser_pool import get_pool
+from common import Job, ModFile, Status
+from download_watch import wait_for_download
+from http_client import MODRINTH_API, modrinth_session
+from jar_store import get_store
+from journal import JobJournal
 from mgmt_tools import MgmtApiHelper, MgmtApiLogger
+from modrinth_api import DeltaFilter, get_file_hashes, upload_matches
+from rate_limit import backoff_delay
+from streaming import (
+    ChecksumError,
+    HashedChunks,
+    MultipartStream,
+    StreamLengthError,
+    iter_file,
+)
 
 
 def driver_get(driver: webdriver, url: str, timeout=30) -> bool:
@@ -57,207 +72,302 @@ class SlowProvider(MgmtApiLogger):
     The class for handling slow downloads
     Args:
         helper (MgmtApiHelper): the job database
-        job_id (str): the job id for the given job
+        job (Job): the job to process
+        curse (CurseClient): the job's CurseForge client
     """
 
-    def __init__(self, helper: MgmtApiHelper, job: Job):
+    def __init__(self, helper: MgmtApiHelper, job: Job, curse: cf.CurseClient):
         super().__init__(helper, job.job_id)
         self._helper = helper
         self._job = job
-        self._modid = cf.get_modid(job.curseforge_slug, self.logmsg)
+        self._curse = curse
         self._rel_map = {1: "release", 2: "beta", 3: "alpha"}
-        # region CHROME DRIVER AND OPTIONS
-        options = Options()
-        options.add_argument("--no-sandbox")
-        options.add_argument("--ignore-ssl-errors=yes")
-        options.add_argument("--ignore-certificate-errors")
-        options.add_argument("--disable-dev-shm-usage")
-        options.add_experimental_option("excludeSwitches", ["enable-logging"])
-        options.add_experimental_option(
-            "prefs",
-            {
-                "download.default_directory": path.realpath(
-                    f"./out/{self._job.curseforge_slug}/"
-                ),
-                "download.prompt_for_download": False,
-                "download.directory_upgrade": True,
-                "safebrowsing.enabled": True,
-            },
-        )
-        self._driver = webdriver.Chrome(
-            service=Service(ChromeDriverManager().install()), options=options
-        )
-        # endregion CHROME DRIVER AND OPTIONS
+        self._tabs = max(1, int(env.get("CTM_SLOW_TABS", "3")))
+        self._out_dir = path.realpath(f"./out/{self._job.job_id}/")
 
-    def _build_manifest(self) -> Union[dict, None]:
+    def _build_manifest(self) -> Union[Dict[str, ModFile], None]:
         """
         Builds a manifest JSON to be used during Modrinth upload
         """
         self.logmsg("ℹ️ Building Manifest for Jar Info")
-        manifest = {}
+        manifest: Dict[str, ModFile] = {}
 
         self.logmsg("ℹ️ Retrieving Curse ModID from Slug")
-        if not self._modid:
+        if not self._curse.mod_id:
             return None
 
         self.logmsg("ℹ️ Enumerating Curse API Pages")
-        pages, last_size = cf.get_pages(self._modid, self.logmsg)
-        if pages == -1 and last_size == -1:
+        total = self._curse.get_file_count()
+        if total == -1:
             return None
 
-        # region ITERATE OVER PAGES AND DOWNLOAD MOD INFO
-        self.logmsg(f"ℹ️ Building manifest for {(pages*50)+last_size} files")
-        for idx in range(pages):
-            try:
-                response = requests.get(
-                    f"https://api.curseforge.com/v1/mods/{self._modid}/files?index={idx}",
-                    headers={"x-api-key": env["CURSE_API_KEY"]},
-                    timeout=30,
-                )
-                for mod in response.json()["data"]:
-                    manifest[mod["fileName"]] = mod
-            except TimeoutError:
-                self.logmsg(
-                    f"🕜 Timed out enumerating files for {self._job.curseforge_slug} ({self._modid})"
-                )
-                continue
-
-        if last_size != 0:
-            try:
-                response = requests.get(
-                    f"https://api.curseforge.com/v1/mods/{self._modid}/files?index={pages}&pageSize={last_size}",
-                    headers={"x-api-key": env["CURSE_API_KEY"]},
-                    timeout=30,
-                )
-                for mod in response.json()["data"]:
-                    manifest[mod["fileName"]] = mod
-            except TimeoutError:
-                self.logmsg(
-                    f"🕜 Timed out enumerating files for {self._job.curseforge_slug} ({self._modid})"
-                )
-
-        # endregion ITERATE OVER PAGES AND DOWNLOAD MOD INFO
-
-        for val in manifest.values():
-            url = f"https://legacy.curseforge.com/minecraft/mc-mods/{self._job.curseforge_slug}/download/{val['id']}"
-            val["downloadUrl"] = url
+        self.logmsg(f"ℹ️ Building manifest for {total} files")
+        for mod in self._curse.iter_files():
+            url = f"https://legacy.curseforge.com/minecraft/mc-mods/{self._job.curseforge_slug}/download/{mod.file_id}"
+            manifest[mod.file_name] = replace(mod, download_url=url)
 
         self.logmsg(f"ℹ️ Manifest Built! {len(manifest.keys())} Mods Found")
         return manifest
 
-    def process(self) -> Status:
-        """Returns: (status): the status of the procedure"""
-        self.logmsg("ℹ️ Retrieving Curse ModID from Slug")
-        if not self._modid:
-            return Status.FAIL
-
-        mods = self._build_manifest()
-        if not mods:
-            self.logmsg("🔥 Failed to create Manifest, see logs for info")
-            return Status.FAIL
-
-        makedirs(f"./out/{self._job.curseforge_slug}", exist_ok=True)
-
-        statuses: List[Status] = []
-        for fpath, mod in mods.items():
-            if (
-                not mod["isAvailable"]
-                or "downloadUrl" not in mod
-                or not mod["downloadUrl"]
-            ):
-                continue
-
-            display_nm = mod["displayName"]
-
-            # region DOWNLOAD THE MOD
-            success = False
+    def _download_batch(
+        self, driver: webdriver.Chrome, batch: List[ModFile]
+    ) -> List[bool]:
+        """
+        Downloads a batch of mods side by side, one browser tab per mod
+        Args:
+            driver (Chrome): the leased browser
+            batch (List[ModFile]): the manifest entries to download
+        Returns: (List[bool]): whether each mod finished downloading, in batch order
+        """
+        started = []
+        for idx, mod in enumerate(batch):
+            display_nm = mod.display_name
             try:
-                driver_get(self._driver, mod["downloadUrl"])
-                sleep(8)
-                success = True
+                if idx >= len(driver.window_handles):
+                    driver.switch_to.new_window("tab")
+                else:
+                    driver.switch_to.window(driver.window_handles[idx])
+                driver_get(driver, mod.download_url)
+                started.append(True)
             except selex.TimeoutException:
                 self.logmsg(
                     f"🕜 Timed out while downloading {display_nm}. This file will need manual migration."
                 )
-                statuses.append(Status.FAIL)
-                continue
+                started.append(False)
             except selex.WebDriverException as exception:
                 self.logmsg(
                     f"🔥 Could not download {display_nm}. RAW ERR: {exception}. This file will need manual migration"
                 )
-                statuses.append(Status.FAIL)
-                continue
-            # endregion DOWNLOAD THE MOD
+                started.append(False)
 
-            if not success:
-                continue
+        finished = []
+        for mod, ok in zip(batch, started):
+            if ok and not wait_for_download(
+                self._out_dir, mod.file_name, mod.file_length
+            ):
+                self.logmsg(
+                    f"🕜 Timed out while downloading {mod.display_name}. This file will need manual migration."
+                )
+                ok = False
+            if ok:
+                metrics.BYTES.labels("downloaded").inc(
+                    path.getsize(path.join(self._out_dir, mod.file_name))
+                )
+            finished.append(ok)
+        return finished
 
-            # region UPLOAD THE MOD
-            with open(f"./out/{self._job.curseforge_slug}/{fpath}", "rb") as jar_file:
-                jar_data = jar_file.read()
+    def _check_download(self, mod: ModFile) -> Union[BinaryIO, None]:
+        """
+        Checks a freshly downloaded jar against Curse's sha1, moving it into the jar
+            store on the way if there is one
+        Args: mod (ModFile): the manifest entry for the mod
+        Returns: (Union[BinaryIO, None]): the jar open for reading - its blob if it
+            went into the store - None if it did not match its checksum, in which
+            case it is removed
+        """
+        store = get_store()
+        jar_path = path.join(self._out_dir, mod.file_name)
+        try:
+            if store and store.accepts(mod):
+                with open(jar_path, "rb") as src:
+                    blob = store.fill(mod, HashedChunks(iter_file(src), mod.sha1))
+                rm(jar_path)
+                return blob
 
-            game_versions, loaders = cf.get_loader_info(mod["gameVersions"])
-            payload = json.dumps(
-                {
-                    "name": display_nm,
-                    "version_number": cf.get_version(display_nm),
-                    "changelog": cf.get_changelog(self._modid, mod["id"]),
-                    "dependencies": [],  # Dependencies need to be manually included
-                    "game_versions": game_versions,
-                    "loaders": loaders,
-                    "featured": False,
-                    "version_type": self._rel_map[mod["releaseType"]],
-                    "requested_status": "listed",
-                    "project_id": self._job.modrinth_id,
-                    "primary_file": fpath,
-                    "file_parts": [fpath],
-                }
-            )
+            with open(jar_path, "rb") as src:
+                for _ in HashedChunks(iter_file(src), mod.sha1):
+                    pass
+            return open(jar_path, "rb")  # pylint: disable=consider-using-with
+        except ChecksumError:
+            if path.exists(jar_path):
+                rm(jar_path)
+            return None
+
+    def _upload_mod(self, mod: ModFile, jar_file: BinaryIO) -> Status:
+        """
+        Uploads a single downloaded mod to Modrinth
+        Args:
+            mod (ModFile): the manifest entry for the mod
+            jar_file (BinaryIO): the jar, open for reading - held open by the caller
+                so a stored blob cannot be evicted in between retries
+        Returns: (Status): the status of the upload
+        """
+        fpath = mod.file_name
+        display_nm = mod.display_name
+        jar_path = path.join(self._out_dir, fpath)
+        payload = json.dumps(
+            {
+                "name": display_nm,
+                "version_number": mod.version_number,
+                "changelog": self._curse.get_changelog(mod.file_id),
+                "dependencies": [],  # Dependencies need to be manually included
+                "game_versions": mod.game_versions,
+                "loaders": mod.loaders,
+                "featured": False,
+                "version_type": self._rel_map[mod.release_type],
+                "requested_status": "listed",
+                "project_id": self._job.modrinth_id,
+                "primary_file": fpath,
+                "file_parts": [fpath],
+            }
+        )
 
-            tries, msg = 1, ""
-            while tries <= 5:
-                try:
-                    response = requests.post(
-                        "https://api.modrinth.com/v2/version",
+        tries, msg = 1, ""
+        while tries <= 5:
+            try:
+                with metrics.stage("upload"):
+                    jar_file.seek(0)
+                    chunks = HashedChunks(iter_file(jar_file), mod.sha1)
+                    body = MultipartStream(
+                        payload, fpath, chunks, fstat(jar_file.fileno()).st_size
+                    )
+                    response = modrinth_session().post(
+                        f"{MODRINTH_API}/v2/version",
                         timeout=30,
-                        headers={"Authorization": self._job.oauth_token},
-                        files=[
-                            ("data", (None, payload, None)),
-                            ("files", (fpath, jar_data, "application/octet-stream")),
-                        ],
+                        headers={
+                            "Authorization": self._job.oauth_token,
+                            "Content-Type": body.content_type,
+                        },
+                        data=body,
                     )
-                    if response.status_code == 200:
-                        statuses.append(Status.SUCCESS)
-                        self.logmsg(f"✅ {display_nm}")
-                    else:
-                        statuses.append(Status.FAIL)
+                if response.status_code == 429:
+                    tries += 1
+                    metrics.retried(MODRINTH_API)
+                    msg = f"🕜 Modrinth kept rate limiting {fpath}. Manual upload required"
+                    continue  # The rate limiter already backs off for us
+
+                if path.exists(jar_path):
+                    rm(jar_path)
+                if response.status_code == 200:
+                    if not upload_matches(response.json(), chunks.sha512):
                         self.logmsg(
-                            dedent(
-                                f"""----- 🔥 {display_nm} -----
-                                API Response from Modrinth FAIL for {display_nm}:
-                                {self.decode_modrinth_resp(response)}
-                                """
-                            ).strip("\n")
+                            f"🔥 {display_nm} was changed on the way to Modrinth, please check it manually"
                         )
+                        return Status.FAIL
+                    self.logmsg(f"✅ {display_nm}")
+                    return Status.SUCCESS
 
-                    rm(f"./out/{self._job.curseforge_slug}/{fpath}")
-                    break
-                except (
-                    requests.exceptions.ReadTimeout,
-                    ReadTimeoutError,
-                    TimeoutError,
-                ):
-                    tries += 1
-                    msg = f"🕜 Timed out uploading {fpath}. Manual upload required"
-                    continue
-                except (ProtocolError, requests.exceptions.ChunkedEncodingError):
-                    tries += 1
-                    msg = f"🔥 Uploading {display_nm} to Modrinth failed, skipping.."
+                self.logmsg(
+                    dedent(
+                        f"""----- 🔥 {display_nm} -----
+                        API Response from Modrinth FAIL for {display_nm}:
+                        {self.decode_modrinth_resp(response)}
+                        """
+                    ).strip("\n")
+                )
+                return Status.FAIL
+            except (
+                requests.exceptions.ReadTimeout,
+                ReadTimeoutError,
+                TimeoutError,
+            ):
+                tries += 1
+                msg = f"🕜 Timed out uploading {fpath}. Manual upload required"
+                metrics.retried(MODRINTH_API)
+                sleep(backoff_delay(tries))
+                continue
+            except (
+                ProtocolError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ConnectionError,
+                StreamLengthError,
+            ):
+                tries += 1
+                msg = f"🔥 Uploading {display_nm} to Modrinth failed, skipping.."
+                metrics.retried(MODRINTH_API)
+                sleep(backoff_delay(tries))
+                continue
+
+        self.logmsg(msg)
+        return Status.FAIL
+
+    def process(self) -> Status:
+        """Returns: (status): the status of the procedure"""
+        self.logmsg("ℹ️ Retrieving Curse ModID from Slug")
+        with profiling.phase("slug_lookup"):
+            if not self._curse.mod_id:
+                return Status.FAIL
+
+        with profiling.phase("enumerate"):
+            mods = self._build_manifest()
+        if not mods:
+            self.logmsg("🔥 Failed to create Manifest, see logs for info")
+            return Status.FAIL
+
+        self.logmsg("ℹ️ Comparing against files already on Modrinth")
+        with profiling.phase("delta"):
+            delta = DeltaFilter(
+                get_file_hashes(
+                    self._job.modrinth_id, self._job.oauth_token, self.logmsg
+                )
+            )
+        journal = JobJournal(self._job.job_id)
+        queue = [
+            x
+            for x in mods.values()
+            if x.is_available
+            and x.download_url
+            and journal.is_pending(x)
+            and delta.is_new(x)
+        ]
+        # Changelogs are fetched while the browser works through the downloads
+        for mod in queue:
+            self._curse.prefetch_changelog(mod.file_id)
+
+        statuses: List[Status] = []
+        if journal.replayed:
+            self.logmsg(
+                f"⏭️ Resumed past {len(journal.replayed)} files finished by an earlier run"
+            )
+            statuses.extend(journal.replayed)
+        if delta.skipped:
+            self.logmsg(f"⏭️ Skipped {delta.skipped} files already on Modrinth")
+            statuses.extend([Status.SUCCESS] * delta.skipped)
+            metrics.FILES.labels("slow", "SKIPPED").inc(delta.skipped)
+        # Jars already in the store go straight to Modrinth, only the rest need
+        # the browser. Each blob is held open for its upload, so it cannot be
+        # evicted half way.
+        store = get_store()
+        unstored: List[ModFile] = []
+        makedirs(self._out_dir, exist_ok=True)
+        try:
+            for mod in queue:
+                blob = store.open_blob(mod) if store else None
+                if not blob:
+                    unstored.append(mod)
                     continue
-            if tries == 5:
-                self.logmsg(msg)
-                statuses.append(Status.FAIL)
-            # endregion UPLOAD THE MOD
+                with blob, profiling.phase("upload"):
+                    status = self._upload_mod(mod, blob)
+                journal.record(mod.file_id, status)
+                metrics.FILES.labels("slow", status.name).inc()
+                statuses.append(status)
+            queue = unstored
+
+            if queue:
+                with get_pool().lease(self._out_dir) as driver:
+                    for start in range(0, len(queue), self._tabs):
+                        batch = queue[start : start + self._tabs]
+                        with metrics.stage("download"), profiling.phase("download"):
+                            downloads = self._download_batch(driver, batch)
+                        for mod, downloaded in zip(batch, downloads):
+                            jar_file = self._check_download(mod) if downloaded else None
+                            if downloaded and not jar_file:
+                                self.logmsg(
+                                    f"🔥 {mod.display_name} from Curse did not match its checksum. This file will need manual migration."
+                                )
+                            with jar_file or nullcontext(), profiling.phase("upload"):
+                                status = (
+                                    self._upload_mod(mod, jar_file)
+                                    if jar_file
+                                    else Status.FAIL
+                                )
+                            journal.record(mod.file_id, status)
+                            metrics.FILES.labels("slow", status.name).inc()
+                            statuses.append(status)
+        finally:
+            self._curse.cancel_prefetch()
+            journal.close()
+            rmdir(self._out_dir, ignore_errors=True)
 
         any_succ = len(list(filter(lambda x: x == Status.SUCCESS, statuses))) > 0
         any_fail = len(list(filter(lambda x: x == Status.FAIL, statuses))) > 0
@@ -266,5 +376,4 @@ class SlowProvider(MgmtApiLogger):
             if any_succ and any_fail
             else Status.SUCCESS if any_succ and not any_fail else Status.FAIL
         )
-        rmdir(f"./out/{self._job.curseforge_slug}")
         return status